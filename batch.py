@@ -0,0 +1,208 @@
+import argparse
+import contextlib
+import functools
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+import main
+import music_export as me
+import midi_export as midi
+import stage_cache as sc
+
+
+EXPORT_WRITERS = dict(me.WRITERS, mid=midi.MidiWriter)
+
+_stage_caches = {}
+
+
+def get_stage_cache(directory, max_bytes):
+    """Stage cache of this process for directory, created once
+    :param directory:
+    :param max_bytes:
+    """
+    key = (directory, max_bytes)
+    if key not in _stage_caches:
+        _stage_caches[key] = sc.StageCache(directory, max_bytes)
+    return _stage_caches[key]
+
+
+def expand_paths(paths):
+    """
+    Expands globs and folders into list of files
+    :param paths: file paths, folders or glob patterns
+    :return: list of file paths, in given order, folders and globs sorted
+    """
+    files = []
+    for path in paths:
+        if any(char in path for char in '*?['):
+            files.extend(sorted(glob.glob(path)))
+        elif os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                                if os.path.isfile(os.path.join(path, f))))
+        else:
+            files.append(path)
+    return files
+
+
+def recognize_file(path, verbose=False, debug_dir=None, export_dir=None, export_format='jsonl',
+                   export_options=None, cache_dir=None, cache_size=1 << 30, band_height=None):
+    """
+    Recognizes one file, catching any error it raises
+    :param path: path to the image
+    :param verbose: write recognition output to stderr instead of discarding it
+    :param debug_dir: directory staff images are written to, None to write nothing
+    :param export_dir: directory recognized music is written to, one file per image, None to write nothing
+    :param export_format: format of exported music, one of EXPORT_WRITERS
+    :param export_options: keyword arguments of the export writer
+    :param cache_dir: directory of stage cache, None to compute every stage
+    :param cache_size: size limit of stage cache in bytes
+    :param band_height: rows of a band in large image mode, None to process whole page
+    :return: result record of the file
+    """
+    record = {'file': path, 'status': 'ok', 'seconds': 0., 'error': None, 'staves': []}
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        try:
+            with contextlib.redirect_stdout(sys.stderr if verbose else devnull):
+                writers = []
+                if export_dir is not None:
+                    os.makedirs(export_dir, exist_ok=True)
+                    export_path = os.path.join(export_dir, "%s.%s" % (
+                        os.path.splitext(os.path.basename(path))[0], export_format))
+                    writers += [EXPORT_WRITERS[export_format](export_path, **(export_options or {}))]
+                stage_cache = get_stage_cache(cache_dir, cache_size) if cache_dir is not None else None
+                try:
+                    staves = main.perform_recognition(path, debug_dir=debug_dir, writers=writers,
+                                                      print_results=verbose, stage_cache=stage_cache,
+                                                      band_height=band_height)
+                finally:
+                    for writer in writers:
+                        writer.close()
+            record['staves'] = staves
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = "%s: %s" % (type(e).__name__, e)
+            record['traceback'] = traceback.format_exc()
+    record['seconds'] = round(time.time() - start, 3)
+    return record
+
+
+def recognize_files(paths, workers=None, chunksize=1, ordered=True, output=None, verbose=False,
+                    debug_dir=None, export_dir=None, export_format='jsonl', export_options=None,
+                    cache_dir=None, cache_size=1 << 30, band_height=None):
+    """
+    Recognizes files in a process pool, writing one JSON line per file
+    :param paths: file paths, folders or glob patterns
+    :param workers: number of worker processes, None for number of cores, 1 to run in this process
+    :param chunksize: number of files sent to a worker at once
+    :param ordered: write records in order of files, otherwise as they complete
+    :param output: file object records are written to, None to only return them
+    :param verbose: write recognition output to stderr
+    :param debug_dir: directory staff images are written to, None to write nothing
+    :param export_dir: directory recognized music is written to, one file per image, None to write nothing
+    :param export_format: format of exported music, one of EXPORT_WRITERS
+    :param export_options: keyword arguments of the export writer
+    :param cache_dir: directory of stage cache, None to compute every stage
+    :param cache_size: size limit of stage cache in bytes
+    :param band_height: rows of a band in large image mode, None to process whole page
+    :return: list of result records
+    """
+    if export_format not in EXPORT_WRITERS:
+        raise Exception("Unknown export format: %s" % export_format)
+    files = expand_paths(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(files)))
+    task = functools.partial(recognize_file, verbose=verbose, debug_dir=debug_dir,
+                             export_dir=export_dir, export_format=export_format,
+                             export_options=export_options, cache_dir=cache_dir, cache_size=cache_size,
+                             band_height=band_height)
+
+    records = []
+    pool = None
+    if workers == 1:
+        results = map(task, files)
+    else:
+        pool = multiprocessing.Pool(workers)
+        if ordered:
+            results = pool.imap(task, files, chunksize)
+        else:
+            results = pool.imap_unordered(task, files, chunksize)
+    try:
+        for record in results:
+            if output is not None:
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+            records.append(record)
+        if pool is not None:
+            pool.close()
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+    return records
+
+
+def run(args=None):
+    parser = argparse.ArgumentParser(description="Recognize music on scanned pages")
+    parser.add_argument('paths', nargs='+', help="image files, folders or glob patterns")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="number of worker processes (default: number of cores)")
+    parser.add_argument('-c', '--chunksize', type=int, default=1,
+                        help="number of files sent to a worker at once")
+    parser.add_argument('-u', '--unordered', action='store_true',
+                        help="write records as files complete, not in given order")
+    parser.add_argument('-o', '--output', default=None,
+                        help="JSON Lines file to write records to (default: stdout)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="write recognition output to stderr")
+    parser.add_argument('-d', '--debug-dir', default=None,
+                        help="directory staff images are written to as PNG")
+    parser.add_argument('-e', '--export-dir', default=None,
+                        help="directory recognized music is written to, one file per image")
+    parser.add_argument('-f', '--export-format', default='jsonl', choices=sorted(EXPORT_WRITERS),
+                        help="format of exported music")
+    parser.add_argument('-s', '--staves-per-system', type=int, default=None,
+                        help="staves merged into one system, for MIDI export")
+    parser.add_argument('--cache-dir', default=None,
+                        help="directory of stage cache, reused between runs")
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help="size limit of stage cache in MB")
+    parser.add_argument('-b', '--band-height', type=int, default=None,
+                        help="process large images in bands of this many rows, "
+                             "from a memory-mapped grayscale page; images other than "
+                             ".npy are decoded whole once to write that page")
+    args = parser.parse_args(args)
+
+    export_options = None
+    if args.staves_per_system is not None:
+        if args.export_format != 'mid':
+            parser.error("--staves-per-system is only used with --export-format mid")
+        export_options = {'staves_per_system': args.staves_per_system}
+
+    start = time.time()
+    if args.output is None:
+        records = recognize_files(args.paths, args.workers, args.chunksize,
+                                  not args.unordered, sys.stdout, args.verbose, args.debug_dir,
+                                  args.export_dir, args.export_format, export_options,
+                                  args.cache_dir, args.cache_size << 20, args.band_height)
+    else:
+        with open(args.output, 'w') as output:
+            records = recognize_files(args.paths, args.workers, args.chunksize,
+                                      not args.unordered, output, args.verbose, args.debug_dir,
+                                      args.export_dir, args.export_format, export_options,
+                                      args.cache_dir, args.cache_size << 20, args.band_height)
+    failed = len([record for record in records if record['status'] != 'ok'])
+    sys.stderr.write("%d files, %d failed, %.1f s\n" % (len(records), failed, time.time() - start))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
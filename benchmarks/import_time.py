@@ -0,0 +1,70 @@
+"""
+Measures import time of pipeline modules, each in a fresh interpreter,
+and checks it stays within budget and that no GUI module is imported.
+
+    python benchmarks/import_time.py [--budget MS] [--repeat N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ('image_processing', 'image_operations', 'staff_lines', 'image_region_recognition',
+           'instrumentation', 'stage_cache', 'stage_graph', 'large_image', 'packed_image',
+           'template_matching', 'music_export', 'midi_export',
+           'music_classification', 'main', 'batch')
+
+FORBIDDEN_MODULES = ('matplotlib',)
+
+
+def measure_import(module):
+    """
+    Imports module in a fresh interpreter, using -X importtime
+    :param module: module name
+    :return: cumulative import time in milliseconds, list of forbidden modules that got imported
+    """
+    check = "import sys, %s; print(','.join(m for m in %r if m in sys.modules))" % (module, FORBIDDEN_MODULES)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', check], cwd=ROOT,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise Exception("Importing %s failed:\n%s" % (module, process.stderr))
+    cumulative = None
+    for line in process.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            cumulative = int(parts[1]) / 1000.
+    forbidden = [m for m in process.stdout.strip().split(',') if m]
+    return cumulative, forbidden
+
+
+def run(args=None):
+    parser = argparse.ArgumentParser(description="Check import time of pipeline modules")
+    parser.add_argument('--budget', type=float, default=400.,
+                        help="budget for importing any single module, in milliseconds")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of measurements per module, best one is kept")
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    args = parser.parse_args(args)
+
+    failed = False
+    for module in args.modules:
+        best = None
+        for _ in range(args.repeat):
+            milliseconds, forbidden = measure_import(module)
+            best = milliseconds if best is None else min(best, milliseconds)
+        status = "ok"
+        if forbidden:
+            status = "imports %s" % ", ".join(forbidden)
+            failed = True
+        elif best > args.budget:
+            status = "over budget"
+            failed = True
+        print("%-28s %8.1f ms  %s" % (module, best, status))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
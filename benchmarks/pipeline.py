@@ -0,0 +1,175 @@
+"""
+Runs the recognition pipeline over bundled pages and reports time of each stage,
+pages per second, peak memory and number of regions found.
+
+    python benchmarks/pipeline.py [paths...] [--repeat N] [--output results.json] [--compare old.json]
+
+Stages are the instrumentation spans of the pipeline. Their times and counters are
+inclusive, e.g. template_match time is also part of get_clefs time. Pages per second
+count only pages that were recognized, and the benchmark exits with status 1 when
+a page fails.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import batch
+import instrumentation as ins
+import main
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+DEFAULT_PATHS = ('test_images', 'test_dataset')
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, None where it can not be read"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_page(path, workers=1):
+    """
+    :param path: path to the image
+    :param workers: number of worker processes for staff analysis
+    :return: record of the page
+    """
+    sink = ins.enable(ins.MemorySink())
+    record = {'file': path, 'status': 'ok', 'error': None, 'staves': 0}
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        try:
+            with contextlib.redirect_stdout(devnull):
+                staves = main.perform_recognition(path, workers=workers, print_results=False)
+            record['staves'] = len(staves)
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = "%s: %s" % (type(e).__name__, e)
+        finally:
+            ins.disable()
+    record['seconds'] = time.perf_counter() - start
+    totals = sink.totals()
+    record['stages'] = dict((name, {'seconds': total['duration'], 'calls': total['calls'],
+                                    'counters': total['counters']})
+                            for name, total in totals.items() if name != 'perform_recognition')
+    record['counters'] = totals.get('perform_recognition', {'counters': {}})['counters']
+    record['regions'] = record['counters'].get(ins.REGIONS_FOUND, 0)
+    # high-water mark of the process so far, not of this page alone
+    record['cumulative_peak_rss_mb'] = peak_rss_mb()
+    return record
+
+
+def run_benchmark(paths, repeat=1, workers=1):
+    """
+    :param paths: files, folders or glob patterns
+    :param repeat: number of runs over all pages
+    :param workers: number of worker processes for staff analysis, stages are only
+    recorded in this process
+    :return: results of the benchmark
+    """
+    files = batch.expand_paths([os.path.join(ROOT, path) if not os.path.isabs(path) else path
+                                for path in paths])
+    pages = []
+    stages = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in files:
+            record = benchmark_page(path, workers)
+            record['file'] = os.path.relpath(path, ROOT)
+            pages += [record]
+            for name, stage in record['stages'].items():
+                total = stages.setdefault(name, {'seconds': 0., 'calls': 0, 'counters': {}})
+                total['seconds'] += stage['seconds']
+                total['calls'] += stage['calls']
+                for counter, value in stage['counters'].items():
+                    total['counters'][counter] = total['counters'].get(counter, 0) + value
+    seconds = time.perf_counter() - start
+    recognized = [page for page in pages if page['status'] == 'ok']
+    recognized_seconds = sum(page['seconds'] for page in recognized)
+    return {'commit': git_commit(), 'python': platform.python_version(), 'workers': workers,
+            'repeat': repeat, 'pages': pages, 'stages': stages, 'seconds': seconds,
+            'pages_per_second': len(recognized) / recognized_seconds if recognized_seconds > 0 else None,
+            'failed': len(pages) - len(recognized),
+            'regions': sum(page['regions'] for page in pages), 'peak_rss_mb': peak_rss_mb()}
+
+
+def print_results(results, baseline=None):
+    print("%-40s %8s %7s %8s %6s" % ("page", "seconds", "staves", "regions", "status"))
+    for page in results['pages']:
+        print("%-40s %8.2f %7s %8s %6s" % (page['file'], page['seconds'], page['staves'],
+                                          page['regions'], page['status']))
+    print("")
+    print("%-28s %10s %8s %10s %12s %9s %11s" % ("stage", "seconds", "calls", "change", "pixels",
+                                                 "regions", "templates"))
+    for name, stage in sorted(results['stages'].items(), key=lambda item: -item[1]['seconds']):
+        change = ""
+        if baseline is not None and name in baseline['stages'] and baseline['stages'][name]['seconds'] > 0:
+            change = "%+.1f%%" % (100. * (stage['seconds'] / baseline['stages'][name]['seconds'] - 1))
+        counters = stage.get('counters', {})
+        print("%-28s %10.3f %8s %10s %12s %9s %11s" % (name, stage['seconds'], stage['calls'], change,
+                                                      counters.get(ins.PIXELS_SCANNED, ''),
+                                                      counters.get(ins.REGIONS_FOUND, ''),
+                                                      counters.get(ins.TEMPLATE_COMPARISONS, '')))
+    print("")
+    print("total %.2f s, %.3f recognized pages/s, %s failed, %s regions, peak RSS %s MB"
+          % (results['seconds'], results['pages_per_second'] or 0, results['failed'], results['regions'],
+             "%.1f" % results['peak_rss_mb'] if results['peak_rss_mb'] is not None else "?"))
+    if baseline is not None:
+        print("baseline %s: %.2f s, %.3f pages/s"
+              % (baseline.get('commit'), baseline['seconds'], baseline['pages_per_second'] or 0))
+
+
+def run(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark recognition pipeline")
+    parser.add_argument('paths', nargs='*', default=DEFAULT_PATHS,
+                        help="image files, folders or glob patterns (default: bundled pages)")
+    parser.add_argument('--repeat', type=int, default=1, help="number of runs over all pages")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes for staff analysis, stages are only recorded in this process")
+    parser.add_argument('--output', default=None, help="JSON file results are written to")
+    parser.add_argument('--compare', default=None, help="JSON results of an earlier run to compare to")
+    args = parser.parse_args(args)
+
+    results = run_benchmark(args.paths, args.repeat, args.workers)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if results['failed'] > 0:
+        print("%s of %s pages failed:" % (results['failed'], len(results['pages'])))
+        for page in results['pages']:
+            if page['status'] != 'ok':
+                print("  %s: %s" % (page['file'], page['error']))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -38,18 +38,14 @@ def project_image(image, projection=HORIZONTAL_PROJECTION):
     :param projection:
     :param image:
     """
-    projected_image = []
-
-    image_height, image_width = image.shape[:2]
-    first_limit = image_height if projection == HORIZONTAL_PROJECTION else image_width
-    second_limit = image_width if projection == HORIZONTAL_PROJECTION else image_height
-    for i in range(first_limit):
-        projection_sum = 0
-        for j in range(second_limit):
-            projection_sum += image[i if projection == HORIZONTAL_PROJECTION else j,
-                                    j if projection == HORIZONTAL_PROJECTION else i] == 255
-        projected_image.append([255] * projection_sum + [0] * (second_limit - projection_sum))
-    return projected_image
+    image = np.asarray(image)
+    if projection == HORIZONTAL_PROJECTION:
+        projection_sums = np.count_nonzero(image == 255, axis=1)
+        length = image.shape[1]
+    else:
+        projection_sums = np.count_nonzero(image == 255, axis=0)
+        length = image.shape[0]
+    return np.where(np.arange(length) < projection_sums[:, np.newaxis], 255, 0).astype(np.uint8)
 
 
 def crop_image(image, crop_start=None, crop_width=None):
@@ -58,13 +54,12 @@ def crop_image(image, crop_start=None, crop_width=None):
     :param crop_start:
     :param crop_width:
     """
+    image = np.asarray(image)
 
     if crop_start is None:
         end = 0
-        for row in image:
-            s = sum(row) / 255
-            if s > end:
-                end = s
+        if len(image) > 0:
+            end = max(int(image.sum(axis=1, dtype=np.int64).max()) // 255, 0)
 
         if crop_width is None:
             crop_width = end // 3
@@ -74,13 +69,7 @@ def crop_image(image, crop_start=None, crop_width=None):
     if crop_width is None:
         crop_width = len(image[0]) // 10
 
-    crop = image[:]
-
-    for i in range(len(crop)):
-        crop[i] = crop[i][crop_start:(crop_start + crop_width)]
-
-    crop = np.array(crop, dtype=np.uint8)
-    return crop
+    return np.array(image[:, crop_start:(crop_start + crop_width)], dtype=np.uint8)
 
 
 def open_image_vertically(image, staff_spacing, multiply_factor=1.5):
@@ -92,29 +81,56 @@ def open_image_vertically(image, staff_spacing, multiply_factor=1.5):
     return open_image(image, np.ones((int(round(multiply_factor * staff_spacing)), 1)))
 
 
-def image_subtract(image1, image2):
+def image_subtract(image1, image2, out=None):
     """Return image that contains only white pixels from
     the first image, but not from the second image
     :param image2:
     :param image1:
+    :param out: image to store the result to, can be image1
+    """
+    return apply_mask(image1, image2 == 255, 0, out)
+
+
+def image_intersect(image1, image2, out=None):
+    """Return image that contains only white pixels from
+    the first image that are also in the second image
+    :param image1:
+    :param image2:
+    :param out: image to store the result to, can be image1
     """
-    ret_image = image1.copy()
-    image_height, image_width = ret_image.shape[:2]
-    for row in range(image_height):
-        for col in range(image_width):
-            if image2[row, col] == 255:
-                ret_image[row, col] = 0
-    return ret_image
+    return apply_mask(image1, image2 != 255, 0, out)
 
 
-def merge_images(images):
+def merge_images(images, out=None):
     """Merge the images and return them as one
     :param images:
+    :param out: image to store the result to, can be the first image
+    """
+    out = copy_image(images[0], out)
+    for image in images[1:]:
+        np.putmask(out, image == 255, 255)
+    return out
+
+
+def apply_mask(image, mask, value=0, out=None):
+    """Return copy of image with pixels set to value where mask is True
+    :param image:
+    :param mask:
+    :param value:
+    :param out: image to store the result to, can be image
+    """
+    out = copy_image(image, out)
+    np.putmask(out, mask, value)
+    return out
+
+
+def copy_image(image, out=None):
+    """Copy image to out, or to a new image if out is None
+    :param image:
+    :param out:
     """
-    ret_image = images[0].copy()
-    for image in images:
-        for row in range(len(image)):
-            for col in range(len(image[0])):
-                if image[row][col] == 255:
-                    ret_image[row][col] = 255
-    return ret_image
+    if out is None:
+        return image.copy()
+    if out is not image:
+        np.copyto(out, image)
+    return out
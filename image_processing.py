@@ -1,5 +1,4 @@
 import cv2
-import matplotlib.pyplot as plt
 
 
 def load_image(path):
@@ -66,10 +65,12 @@ def invert(image):
 
 
 def display_image(image, color=False):
-    """Display image as plot figure
+    """Display image as plot figure.
+    Matplotlib is imported here, so it is never loaded in headless runs.
     :param color:
     :param image:
     """
+    import matplotlib.pyplot as plt
     plt.figure()
     if color:
         plt.imshow(image)
@@ -78,6 +79,17 @@ def display_image(image, color=False):
     plt.show()
 
 
+def save_image(path, image, color=False):
+    """Save image to file, format is chosen by extension
+    :param path:
+    :param image:
+    :param color: image is RGB
+    """
+    if color:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    return cv2.imwrite(path, image)
+
+
 def resize_image(image, size):
     """Resize image to desired size
     :param image:
@@ -1,5 +1,304 @@
+import cv2
 import numpy as np
 import image_operations as imo
+import instrumentation as ins
+import stage_cache as sc
+
+
+REGION_FEATURES = np.dtype([('label', np.int32),
+                            ('top', np.int32),
+                            ('left', np.int32),
+                            ('bottom', np.int32),
+                            ('right', np.int32),
+                            ('area', np.int32),
+                            ('fill_ratio', np.float64),
+                            ('aspect_ratio', np.float64),
+                            ('column_span', np.int32)])
+
+
+class Region(object):
+    """Region of white pixels, stored as arrays of row and column
+    coordinates. Bounding box, centroid and mask are computed once,
+    when first needed. Iterating a region gives (row, col) tuples,
+    so it can be used like a list of coordinates.
+    """
+    __slots__ = ('rows', 'cols', 'label', 'label_map', '_bbox', '_centroid', '_mask')
+
+    def __init__(self, rows, cols, label=None, label_map=None):
+        """
+        :param rows:
+        :param cols:
+        :param label: label of the region in label_map
+        :param label_map: label map the region was found in, see label_regions
+        """
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.cols = np.asarray(cols, dtype=np.int32)
+        self.label = label
+        self.label_map = label_map
+        self._bbox = None
+        self._centroid = None
+        self._mask = None
+
+    @classmethod
+    def from_coordinates(cls, coordinates, label=None):
+        """Make region from list of (row, col) coordinates
+        :param coordinates:
+        :param label:
+        """
+        coordinates = np.array(coordinates, dtype=np.int32).reshape(-1, 2)
+        return cls(coordinates[:, 0], coordinates[:, 1], label)
+
+    def __reduce__(self):
+        # label map is left out, so regions sent between processes
+        # do not carry a copy of the whole label map each
+        return Region, (self.rows, self.cols, self.label)
+
+    @property
+    def bbox(self):
+        """Top row, left column, bottom row and right column"""
+        if self._bbox is None:
+            self._bbox = (int(self.rows.min()), int(self.cols.min()),
+                          int(self.rows.max()), int(self.cols.max()))
+        return self._bbox
+
+    @property
+    def top(self):
+        return self.bbox[0]
+
+    @property
+    def left(self):
+        return self.bbox[1]
+
+    @property
+    def bottom(self):
+        return self.bbox[2]
+
+    @property
+    def right(self):
+        return self.bbox[3]
+
+    @property
+    def height(self):
+        """Number of rows of the bounding box"""
+        return self.bbox[2] - self.bbox[0] + 1
+
+    @property
+    def width(self):
+        """Number of columns of the bounding box"""
+        return self.bbox[3] - self.bbox[1] + 1
+
+    @property
+    def area(self):
+        return len(self.rows)
+
+    @property
+    def centroid(self):
+        """Mean row and mean column"""
+        if self._centroid is None:
+            self._centroid = (float(self.rows.mean()), float(self.cols.mean()))
+        return self._centroid
+
+    @property
+    def mask(self):
+        """Boolean image of the bounding box, True for region pixels"""
+        if self._mask is None:
+            top, left, bottom, right = self.bbox
+            mask = np.zeros((bottom - top + 1, right - left + 1), dtype=bool)
+            mask[self.rows - top, self.cols - left] = True
+            mask.flags.writeable = False
+            self._mask = mask
+        return self._mask
+
+    def rows_between(self, min_row, max_row):
+        """Return region of pixels with min_row <= row <= max_row
+        :param min_row:
+        :param max_row:
+        """
+        selected = (self.rows >= min_row) & (self.rows <= max_row)
+        return Region(self.rows[selected], self.cols[selected])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return zip(self.rows.tolist(), self.cols.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Region(self.rows[index], self.cols[index])
+        return int(self.rows[index]), int(self.cols[index])
+
+    def __contains__(self, coordinate):
+        row, col = coordinate
+        return bool(((self.rows == row) & (self.cols == col)).any())
+
+    def __add__(self, other):
+        other = as_region(other)
+        return Region(np.concatenate((self.rows, other.rows)),
+                      np.concatenate((self.cols, other.cols)))
+
+    def __eq__(self, other):
+        if not isinstance(other, Region):
+            if not isinstance(other, (list, tuple)):
+                return NotImplemented
+            other = Region.from_coordinates(other)
+        return np.array_equal(self.rows, other.rows) and np.array_equal(self.cols, other.cols)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __lt__(self, other):
+        """Compare coordinate lists lexicographically, as lists of tuples are compared
+        :param other:
+        """
+        other = as_region(other)
+        length = min(len(self), len(other))
+        differs = np.flatnonzero((self.rows[:length] != other.rows[:length]) |
+                                 (self.cols[:length] != other.cols[:length]))
+        if len(differs) > 0:
+            index = differs[0]
+            return (self.rows[index], self.cols[index]) < (other.rows[index], other.cols[index])
+        return len(self) < len(other)
+
+    def __repr__(self):
+        return "Region(label=%s, area=%s, bbox=%s)" % (self.label, self.area,
+                                                       self.bbox if self.area > 0 else None)
+
+
+class RegionIndex(object):
+    """Regions of a staff sorted by their left column, for
+    finding the closest region to the right of a column and
+    regions overlapping a range of columns by binary search.
+    The indexed list of regions must not be changed.
+    """
+
+    def __init__(self, regions, features=None):
+        """
+        :param regions:
+        :param features: features of regions, see region_features
+        """
+        if features is None:
+            features = region_features(regions)
+        self.regions = regions
+        indices = np.flatnonzero(features['area'] > 0)
+        indices = indices[np.argsort(features['left'][indices], kind='stable')]
+        self._indices = indices
+        self._lefts = features['left'][indices]
+        self._rights = features['right'][indices]
+        self._max_rights = np.maximum.accumulate(self._rights)
+
+    def closest_right_of(self, col, exceptions=None):
+        """Return the region with the smallest left column greater than col,
+        its left column and its index in regions, or (None, -1, -1).
+        Of regions with the same left column, the first one in regions is returned.
+        :param col:
+        :param exceptions: regions to skip
+        """
+        for position in range(np.searchsorted(self._lefts, col, side='right'), len(self._indices)):
+            index = int(self._indices[position])
+            region = self.regions[index]
+            if exceptions is None or region not in exceptions:
+                return region, int(self._lefts[position]), index
+        return None, -1, -1
+
+    def overlapping(self, min_col, max_col):
+        """Return indices of regions whose bounding box overlaps
+        columns from min_col to max_col, sorted by left column
+        :param min_col:
+        :param max_col:
+        """
+        end = np.searchsorted(self._lefts, max_col, side='right')
+        start = np.searchsorted(self._max_rights[:end], min_col, side='left')
+        positions = np.arange(start, end)
+        return self._indices[positions[self._rights[positions] >= min_col]].tolist()
+
+
+def erase_regions(images, regions):
+    """Set pixels of regions to 0 in all the images, with one mask per image.
+    Regions that came from the same label map are masked by their labels,
+    others by their coordinates. Return the mask.
+    :param images:
+    :param regions:
+    """
+    if len(images) == 0:
+        return None
+    mask = np.zeros(images[0].shape[:2], dtype=bool)
+    label_maps = {}
+    for region in regions:
+        region = as_region(region)
+        if region.label_map is not None and region.label_map.shape == mask.shape:
+            label_maps.setdefault(id(region.label_map), (region.label_map, []))[1].append(region.label)
+        elif len(region) > 0:
+            mask[region.rows, region.cols] = True
+    for label_map, labels in label_maps.values():
+        mask |= erase_labels([], label_map, labels)
+    for image in images:
+        np.putmask(image, mask, 0)
+    return mask
+
+
+def erase_labels(images, label_map, labels):
+    """Set pixels with any of the labels in label_map to 0
+    in all the images. Return the mask of erased pixels.
+    :param images:
+    :param label_map:
+    :param labels:
+    """
+    selected = np.zeros(label_map.max() + 1 if label_map.size > 0 else 1, dtype=bool)
+    selected[[label for label in labels if 0 < label < len(selected)]] = True
+    mask = selected[label_map]
+    for image in images:
+        np.putmask(image, mask, 0)
+    return mask
+
+
+def drop_regions(regions, removed_regions):
+    """Remove regions from the list of regions in place. Regions with
+    labels are matched by their label and label map, others by their coordinates.
+    :param regions:
+    :param removed_regions:
+    """
+    removed_labels = set()
+    unlabeled = []
+    for region in removed_regions:
+        if isinstance(region, Region) and region.label_map is not None:
+            removed_labels.add((id(region.label_map), region.label))
+        else:
+            unlabeled.append(region)
+    if len(removed_labels) > 0:
+        regions[:] = [region for region in regions
+                      if not (isinstance(region, Region) and region.label_map is not None and
+                              (id(region.label_map), region.label) in removed_labels)]
+    for region in unlabeled:
+        if region in regions:
+            regions.remove(region)
+
+
+def detach_regions(value):
+    """Copy of lists and tuples of results, with regions that keep neither
+    their label map nor arrays shared with other regions, the same as
+    regions sent between processes
+    :param value:
+    """
+    if isinstance(value, Region):
+        return Region(value.rows.copy(), value.cols.copy(), value.label)
+    if isinstance(value, list):
+        return [detach_regions(item) for item in value]
+    if type(value) is tuple:
+        return tuple(detach_regions(item) for item in value)
+    return value
+
+
+def as_region(region):
+    """Return region as Region, converting lists of coordinates
+    :param region:
+    """
+    if isinstance(region, Region):
+        return region
+    return Region.from_coordinates(region)
 
 
 def add_region(image, row, col, regions, pixel_span=2, eight_way=True):
@@ -56,10 +355,207 @@ def add_region(image, row, col, regions, pixel_span=2, eight_way=True):
         regions.append(coordinates)
 
 
-def find_regions(org_image, ref_image=None, pixel_span=2, eight_way=True):
+def find_regions(org_image, ref_image=None, pixel_span=2, eight_way=True, features=False):
     """Find and return regions from org_image,
     according to ref_image. If there's no ref_image, org_image
-    will be it.
+    will be it. If features is True, region features table
+    is returned as well.
+    :param org_image:
+    :param ref_image:
+    :param pixel_span:
+    :param eight_way:
+    :param features:
+    """
+    label_map, regions = _label_regions(org_image, ref_image, pixel_span, eight_way)
+    ins.count(ins.REGIONS_FOUND, len(regions))
+    img_regions = np.where(label_map > 0, 255, 0).astype(org_image.dtype)
+    if features:
+        return img_regions, regions, region_features(regions)
+    return img_regions, regions
+
+
+def _label_regions(org_image, ref_image=None, pixel_span=2, eight_way=True):
+    cache = sc.active()
+    if cache is not None and org_image.size >= sc.MIN_CACHED_PIXELS:
+        return cached_label_regions(cache, org_image, ref_image, pixel_span, eight_way)
+    ins.count(ins.PIXELS_SCANNED, org_image.size)
+    return label_regions(org_image, ref_image, pixel_span, eight_way)
+
+
+def cached_label_regions(cache, org_image, ref_image=None, pixel_span=2, eight_way=True):
+    """label_regions through stage cache, regions of a cached
+    label map are rebuilt from it.
+    :param cache: stage_cache.StageCache
+    :param org_image:
+    :param ref_image:
+    :param pixel_span:
+    :param eight_way:
+    """
+    inputs = [org_image] if ref_image is None else [org_image, ref_image]
+    key = cache.key('label_regions', inputs, {'pixel_span': pixel_span, 'eight_way': eight_way})
+    entry = cache.load(key)
+    if entry is not None:
+        label_map = entry['label_map']
+        return label_map, regions_from_label_map(label_map)
+    ins.count(ins.PIXELS_SCANNED, org_image.size)
+    label_map, regions = label_regions(org_image, ref_image, pixel_span, eight_way)
+    cache.store(key, label_map=label_map)
+    return label_map, regions
+
+
+def region_features(regions):
+    """Return structured array with a row of REGION_FEATURES
+    for every region, in the same order as regions.
+    Column span is the number of columns that contain
+    at least one pixel of the region.
+    :param regions:
+    """
+    regions = [as_region(region) for region in regions]
+    features = np.zeros(len(regions), dtype=REGION_FEATURES)
+    areas = np.array([len(region) for region in regions], dtype=np.int64)
+    features['label'] = [region.label or 0 for region in regions]
+    features['area'] = areas
+    nonempty = np.flatnonzero(areas > 0)
+    if len(nonempty) == 0:
+        return features
+
+    rows = np.concatenate([regions[index].rows for index in nonempty])
+    cols = np.concatenate([regions[index].cols for index in nonempty])
+    starts = np.cumsum(areas[nonempty]) - areas[nonempty]
+    features['top'][nonempty] = np.minimum.reduceat(rows, starts)
+    features['bottom'][nonempty] = np.maximum.reduceat(rows, starts)
+    features['left'][nonempty] = np.minimum.reduceat(cols, starts)
+    features['right'][nonempty] = np.maximum.reduceat(cols, starts)
+
+    heights = features['bottom'][nonempty] - features['top'][nonempty] + 1
+    widths = features['right'][nonempty] - features['left'][nonempty] + 1
+    features['fill_ratio'][nonempty] = areas[nonempty] * 1. / (heights * widths)
+    features['aspect_ratio'][nonempty] = widths * 1. / heights
+
+    region_indices = np.repeat(nonempty, areas[nonempty])
+    columns = np.unique(region_indices * (int(cols.max()) + 1) + cols) // (int(cols.max()) + 1)
+    features['column_span'] = np.bincount(columns, minlength=len(regions))
+    return features
+
+
+def label_regions(org_image, ref_image=None, pixel_span=2, eight_way=True):
+    """Label regions of org_image that contain at least one white pixel
+    of ref_image, in the order of their first such pixel.
+    Return label map, where region i has label i + 1 and all other
+    pixels are 0, and regions with coordinates in row-major order.
+    :param org_image:
+    :param ref_image:
+    :param pixel_span:
+    :param eight_way:
+    """
+    white = org_image == 255
+    if ref_image is None:
+        seeds = white
+    else:
+        seeds = (np.uint8(np.array(ref_image)) == 255) & white
+
+    label_map = label_image(white, pixel_span, eight_way)
+    seed_labels = label_map[seeds]
+    labels, first_indices = np.unique(seed_labels, return_index=True)
+    labels = labels[np.argsort(first_indices)]
+
+    relabel = np.zeros(label_map.max() + 1 if label_map.size > 0 else 1, dtype=np.int32)
+    relabel[labels] = np.arange(1, len(labels) + 1, dtype=np.int32)
+    label_map = relabel[label_map]
+    return label_map, regions_from_label_map(label_map, len(labels))
+
+
+def regions_from_label_map(label_map, count=None):
+    """Return regions of label map with labels 1..count,
+    with coordinates in row-major order.
+    :param label_map:
+    :param count: number of labels, defaults to largest label
+    """
+    if count is None:
+        count = int(label_map.max()) if label_map.size > 0 else 0
+    rows, cols = np.nonzero(label_map)
+    pixel_labels = label_map[rows, cols]
+    order = np.argsort(pixel_labels, kind='stable')
+    rows = rows[order].astype(np.int32)
+    cols = cols[order].astype(np.int32)
+    ends = np.cumsum(np.bincount(pixel_labels, minlength=count + 1)[1:]).tolist()
+
+    regions = []
+    start = 0
+    for label, end in enumerate(ends, 1):
+        regions.append(Region(rows[start:end], cols[start:end], label, label_map))
+        start = end
+    return regions
+
+
+def label_image(white, pixel_span=2, eight_way=True):
+    """Return label map of connected pixels in boolean image white.
+    Pixels are connected if they are at most pixel_span rows and columns
+    apart, and, when not eight_way, if their row and column offsets
+    sum up to 1 or -1, same as in add_region.
+    :param white:
+    :param pixel_span:
+    :param eight_way:
+    """
+    if pixel_span >= 1 and (eight_way or pixel_span == 1):
+        # Pixels at most pixel_span apart have touching squares of
+        # pixel_span x pixel_span, so 8-way labeling of the dilated
+        # image connects exactly them
+        mask = white.astype(np.uint8)
+        if pixel_span > 1:
+            mask = cv2.dilate(mask, np.ones((pixel_span, pixel_span), np.uint8), anchor=(0, 0))
+        label_map = cv2.connectedComponents(mask, connectivity=8 if eight_way else 4, ltype=cv2.CV_32S)[1]
+        label_map[~white] = 0
+        return label_map
+
+    image_height, image_width = white.shape[:2]
+    indices = np.full(white.shape, -1, dtype=np.int64)
+    indices[white] = np.arange(np.count_nonzero(white))
+
+    first_pixels = []
+    second_pixels = []
+    for dr in range(0, pixel_span + 1):
+        for dc in range(-pixel_span, pixel_span + 1):
+            if (dr == 0 and dc <= 0) or not (eight_way or abs(dr + dc) == 1):
+                continue
+            if dr >= image_height or abs(dc) >= image_width:
+                # no pixel pairs this far apart
+                continue
+            first = indices[:image_height - dr, max(0, -dc):image_width - max(0, dc)]
+            second = indices[dr:, max(0, dc):image_width - max(0, -dc)]
+            connected = (first >= 0) & (second >= 0)
+            first_pixels.append(first[connected])
+            second_pixels.append(second[connected])
+
+    parents = np.arange(np.count_nonzero(white))
+    if len(first_pixels) > 0:
+        first_pixels = np.concatenate(first_pixels)
+        second_pixels = np.concatenate(second_pixels)
+        while True:
+            first_roots = parents[first_pixels]
+            second_roots = parents[second_pixels]
+            joined = first_roots != second_roots
+            if not joined.any():
+                break
+            # Hook the larger root under the smaller one, then
+            # compress paths until every pixel points to its root
+            np.minimum.at(parents,
+                          np.maximum(first_roots[joined], second_roots[joined]),
+                          np.minimum(first_roots[joined], second_roots[joined]))
+            while True:
+                grand_parents = parents[parents]
+                if (grand_parents == parents).all():
+                    break
+                parents = grand_parents
+
+    label_map = np.zeros(white.shape, dtype=np.int32)
+    label_map[white] = np.unique(parents, return_inverse=True)[1] + 1
+    return label_map
+
+
+def find_regions_reference(org_image, ref_image=None, pixel_span=2, eight_way=True):
+    """Implementation of find_regions with add_region,
+    kept for parity checks.
     :param org_image:
     :param ref_image:
     :param pixel_span:
@@ -134,15 +630,5 @@ def get_region_image(image, region):
     :param image:
     :param region:
     """
-    min_row = min([r for r, c in region])
-    max_row = max([r for r, c in region])
-    min_col = min([c for r, c in region])
-    max_col = max([c for r, c in region])
-    sub_image = []
-    for row in range(min_row, max_row + 1):
-        sub_image.append([])
-        for col in range(min_col, max_col + 1):
-            sub_image[-1] += [image[row][col]]
-    sub_image = np.array(sub_image)
-    sub_image = np.uint8(sub_image)
-    return sub_image
+    min_row, min_col, max_row, max_col = as_region(region).bbox
+    return np.array(image[min_row:max_row + 1, min_col:max_col + 1], dtype=np.uint8)
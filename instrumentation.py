@@ -0,0 +1,264 @@
+"""
+Nested timing spans with counters, sent to a pluggable sink.
+
+Instrumentation is off until a sink is enabled. While it is off, span()
+returns a shared no-op span, count() returns at once and traced functions
+call straight through, so it can be left in the pipeline.
+
+    sink = instrumentation.enable(instrumentation.ChromeTraceSink("trace.json"))
+    main.perform_recognition("page.png")
+    instrumentation.disable()
+
+Counters of a span include counters of its nested spans.
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+
+PIXELS_SCANNED = 'pixels_scanned'
+REGIONS_FOUND = 'regions_found'
+TEMPLATE_COMPARISONS = 'template_comparisons'
+CACHE_HITS = 'cache_hits'
+CACHE_MISSES = 'cache_misses'
+
+_sink = None
+_epoch = 0.
+_local = threading.local()
+
+
+class Span(object):
+    """Timed section of code, with counters and attributes"""
+    __slots__ = ('name', 'attributes', 'counters', 'parent', 'depth', 'start', 'end')
+
+    def __init__(self, name, attributes=None, parent=None):
+        self.name = name
+        self.attributes = attributes or {}
+        self.counters = {}
+        self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def annotate(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        _stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.perf_counter()
+        stack = _stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        if self.parent is not None:
+            for name, value in self.counters.items():
+                self.parent.count(name, value)
+        sink = _sink
+        if sink is not None:
+            sink.record(self)
+        return False
+
+    def to_dict(self):
+        return {'name': self.name, 'parent': self.parent.name if self.parent is not None else None,
+                'depth': self.depth, 'start': self.start - _epoch, 'duration': self.duration,
+                'counters': dict(self.counters), 'attributes': dict(self.attributes),
+                'pid': os.getpid(), 'tid': threading.current_thread().ident}
+
+
+class NullSpan(object):
+    """Span used while instrumentation is off"""
+
+    def count(self, name, value=1):
+        pass
+
+    def annotate(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def enabled():
+    return _sink is not None
+
+
+def enable(sink):
+    """Start sending spans to sink
+    :param sink: object with record(span) and close() methods
+    :return: sink
+    """
+    global _sink, _epoch
+    _epoch = time.perf_counter()
+    _local.stack = []
+    _sink = sink
+    return sink
+
+
+def disable(close=True):
+    """Stop instrumentation
+    :param close: close the sink
+    :return: sink that was enabled
+    """
+    global _sink
+    sink = _sink
+    _sink = None
+    if sink is not None and close:
+        sink.close()
+    return sink
+
+
+def current_span():
+    if _sink is None:
+        return NULL_SPAN
+    stack = _stack()
+    return stack[-1] if stack else NULL_SPAN
+
+
+def span(name, **attributes):
+    """Context manager timing the code it wraps
+    :param name:
+    :param attributes: values recorded with the span
+    """
+    if _sink is None:
+        return NULL_SPAN
+    stack = _stack()
+    return Span(name, attributes, stack[-1] if stack else None)
+
+
+def count(name, value=1):
+    """Add value to counter of the current span
+    :param name: counter name, e.g. PIXELS_SCANNED
+    :param value:
+    """
+    if _sink is None:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].count(name, value)
+
+
+def annotate(**attributes):
+    """Add attributes to the current span"""
+    if _sink is None:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].annotate(**attributes)
+
+
+def traced(name=None):
+    """Decorator that wraps every call of a function in a span
+    :param name: span name, defaults to function name
+    """
+    def decorate(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _sink is None:
+                return function(*args, **kwargs)
+            stack = _stack()
+            with Span(span_name, None, stack[-1] if stack else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class MemorySink(object):
+    """Keeps spans as dicts, in the order they end"""
+
+    def __init__(self):
+        self.spans = []
+
+    def record(self, span):
+        self.spans.append(span.to_dict())
+
+    def totals(self):
+        """Total duration, calls and counters of each span name"""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span['name'], {'duration': 0., 'calls': 0, 'counters': {}})
+            total['duration'] += span['duration']
+            total['calls'] += 1
+            for name, value in span['counters'].items():
+                total['counters'][name] = total['counters'].get(name, 0) + value
+        return totals
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """Base of sinks writing to a path or an open file object, which is then left open"""
+
+    def __init__(self, output):
+        if isinstance(output, str):
+            self.file = open(output, 'w')
+            self.owns_file = True
+        else:
+            self.file = output
+            self.owns_file = False
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+class JsonSink(FileSink):
+    """Writes one JSON object per span"""
+
+    def record(self, span):
+        self.file.write(json.dumps(span.to_dict()) + "\n")
+
+
+class ChromeTraceSink(FileSink):
+    """Writes spans as complete events of the Chrome trace event format,
+    viewable in chrome://tracing or Perfetto
+    """
+
+    def __init__(self, output):
+        FileSink.__init__(self, output)
+        self.file.write("[\n")
+        self.first = True
+
+    def record(self, span):
+        args = dict(span.attributes)
+        args.update(span.counters)
+        event = {'name': span.name, 'cat': 'omr', 'ph': 'X',
+                 'ts': (span.start - _epoch) * 1e6, 'dur': span.duration * 1e6,
+                 'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': args}
+        self.file.write(("" if self.first else ",\n") + json.dumps(event))
+        self.first = False
+
+    def close(self):
+        self.file.write("\n]\n")
+        FileSink.close(self)
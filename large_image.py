@@ -0,0 +1,187 @@
+"""
+Large image mode, for scans too big to keep several copies of in memory.
+
+The page is kept as uint8 grayscale in a .npy file and only a band of rows
+of it is mapped at a time. Binarization runs band by band, with bands
+overlapping by half of the binarization block, and writes the binarized
+page to another file. Staff lines are found from row sums and horizontal
+openings of single bands, and lines are removed only from the strip of the
+staff that is analyzed. For .npy pages, memory used depends on band
+height and staff strip size, not on page size.
+
+Pages that are not .npy files are decoded whole with OpenCV, so while
+they are written to the page file one color copy of the page is in
+memory. Bands of it are converted to grayscale the same way as load_image
+and image_gray convert the whole page, so results do not depend on the mode.
+"""
+import os
+import cv2
+import numpy as np
+import image_operations as imo
+import image_processing as imp
+import staff_lines as sl
+import instrumentation as ins
+
+
+BAND_HEIGHT = 512
+
+
+class PageFile(object):
+    """2D uint8 image in a .npy file, mapped a band of rows at a time"""
+
+    def __init__(self, path, shape=None):
+        """
+        :param path: .npy file
+        :param shape: shape of a new image, file is created with zeros,
+        None to open an existing file
+        """
+        if shape is not None:
+            np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=tuple(shape)).flush()
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            self.offset = f.tell()
+        if dtype != np.uint8 or len(shape) != 2 or fortran_order:
+            raise Exception("Page file has to be a 2D uint8 array in C order: %s" % path)
+        self.path = path
+        self.shape = shape
+
+    @property
+    def height(self):
+        return self.shape[0]
+
+    @property
+    def width(self):
+        return self.shape[1]
+
+    def rows(self, start, stop, writable=False):
+        """Maps rows from start to stop, clipped to the image
+        :param start:
+        :param stop:
+        :param writable: changes of returned array are written to file
+        """
+        start = min(max(start, 0), self.height)
+        stop = min(max(stop, start), self.height)
+        if stop == start:
+            return np.zeros((0, self.width), dtype=np.uint8)
+        return np.memmap(self.path, dtype=np.uint8, mode='r+' if writable else 'r',
+                         offset=self.offset + start * self.width, shape=(stop - start, self.width))
+
+    def bands(self, band_height=BAND_HEIGHT, overlap=0):
+        """Yields start and stop row of each band, and its rows
+        with overlap rows above and below it
+        :param band_height:
+        :param overlap:
+        """
+        for start in range(0, self.height, band_height):
+            stop = min(start + band_height, self.height)
+            yield start, stop, self.rows(start - overlap, stop + overlap)
+
+
+def load_gray(path, directory, band_height=BAND_HEIGHT):
+    """
+    Grayscale page of an image file. A .npy file is used as it is, other
+    images are decoded whole and written to a file in directory, converted
+    to grayscale band by band. The decoded page is released when it is written.
+    :param path: image or .npy file with 2D uint8 array
+    :param directory: directory the page file is written to
+    :param band_height: rows written at a time
+    :return: PageFile
+    """
+    if path.endswith('.npy'):
+        return PageFile(path)
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise Exception("Can not read image: %s" % path)
+    page = PageFile(os.path.join(directory, "gray.npy"), image.shape[:2])
+    for start in range(0, page.height, band_height):
+        stop = min(start + band_height, page.height)
+        band = page.rows(start, stop, writable=True)
+        band[:] = imp.image_gray(cv2.cvtColor(image[start:stop], cv2.COLOR_BGR2RGB))
+        band.flush()
+        del band
+    return page
+
+
+def binarize(page, path, block_size=9, band_height=BAND_HEIGHT):
+    """Adaptive binarization and inversion of page, band by band.
+    Bands overlap by half of the block, so result is the same as
+    binarization of the whole page.
+    :param page: grayscale PageFile
+    :param path: file binarized page is written to
+    :param block_size: block size of adaptive binarization
+    :param band_height:
+    :return: PageFile
+    """
+    overlap = block_size // 2
+    binarized = PageFile(path, page.shape)
+    for start, stop, rows in page.bands(band_height, overlap):
+        ins.count(ins.PIXELS_SCANNED, rows.size)
+        top = start - max(start - overlap, 0)
+        band = binarized.rows(start, stop, writable=True)
+        band[:] = imp.invert(imp.image_bin_adaptive(np.array(rows), block_size))[top: top + stop - start]
+        band.flush()
+        del band
+    return binarized
+
+
+def find_lines(page, band_height=BAND_HEIGHT):
+    """staff_lines.find_lines of binarized page, from row sums and
+    horizontal openings of single bands
+    :param page: binarized PageFile
+    :param band_height:
+    :return: lines, line distances, average staff spacing, staff distances and average staff distance
+    """
+    row_sums = []
+    for start, stop, rows in page.bands(band_height):
+        ins.count(ins.PIXELS_SCANNED, rows.size)
+        row_sums += [np.count_nonzero(rows == 255, axis=1)]
+    first = sl.projection_rows(np.concatenate(row_sums))
+    avg_staff_spacing = sl.average_spacing(sl.group_rows(first)[1])
+    kernel = np.ones((1, int(2 * avg_staff_spacing)))
+
+    # opening with a one row kernel does not mix rows, so bands need no overlap
+    second = []
+    for start, stop, rows in page.bands(band_height):
+        second += [start + row for row in sl.get_white_rows(imo.open_image(np.array(rows), kernel))]
+    return sl.lines_from_rows(sl.intersect_lists(first, second))
+
+
+def staff_strip(page, lines, index, avg_staff_distance, avg_thickness=None, top_bot_pixel_diff=2):
+    """
+    Strip of staff without staff lines, same as the strip of the page
+    without staff lines. Lines are removed from staves the strip
+    reaches into, read whole with the rows line removal looks at.
+    :param page: binarized PageFile
+    :param lines: staves of the page
+    :param index: index of the staff
+    :param avg_staff_distance: average distance between staves
+    :param avg_thickness: average thickness of staff lines of the page, computed from lines when not given
+    :param top_bot_pixel_diff: rows above and below lines checked by line removal
+    :return: strip and staff with rows relative to the strip
+    """
+    if avg_thickness is None:
+        avg_thickness = sl.average_thickness(lines)
+    staff = lines[index]
+    top = max(int(staff[0][0] - avg_staff_distance // 2), 0)
+    bot = min(int(staff[-1][-1] + avg_staff_distance // 2), page.height)
+
+    staves = []
+    start, stop = top, bot
+    for other in lines:
+        other_top = other[0][0] - top_bot_pixel_diff
+        other_bot = other[-1][-1] + top_bot_pixel_diff + 2
+        if other_top < bot and other_bot > top:
+            staves += [other]
+            start = min(start, max(other_top, 0))
+            stop = max(stop, other_bot)
+    stop = min(stop, page.height)
+    rows = np.array(page.rows(start, stop))
+    ins.count(ins.PIXELS_SCANNED, rows.size)
+    if len(staves) > 0:
+        rows = sl.remove_lines(rows, [[[row - start for row in line] for line in other] for other in staves],
+                               top_bot_pixel_diff=top_bot_pixel_diff, avg_thickness=avg_thickness)
+    return rows[top - start: bot - start], [[row - top for row in line] for line in staff]
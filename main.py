@@ -1,26 +1,57 @@
+import numpy as np
 import image_processing as imp
 import image_operations as imo
 import staff_lines as sl
 import image_region_recognition as irr
 import music_classification as mc
+import music_export as me
+import instrumentation as ins
+import stage_cache as sc
+import stage_graph as sg
+import large_image as li
 import os
+import sys
+import contextlib
+import multiprocessing
+import tempfile
+from collections import namedtuple
+from multiprocessing import shared_memory
 
 
+STAFF_OBJECTS = ('bar_lines', 'clefs', 'time_signatures', 'endings', 'notes',
+                 'accidentals', 'dots', 'whole_notes', 'rests')
+
+StaffResult = namedtuple('StaffResult', ('index', 'staff') + STAFF_OBJECTS + ('staff_spacing', 'staff_distance'))
+
+
+def count_objects(result):
+    """
+    Counts recognized objects of a staff
+    :param result: StaffResult
+    :return: dict with number of objects of each kind
+    """
+    return dict((name, len(getattr(result, name))) for name in STAFF_OBJECTS)
+
+
+@ins.traced()
 def load_image(image_name):
     print("Loading image: %s" % image_name)
     return imp.load_image(image_name)
 
 
+@ins.traced()
 def image_gray(image):
     print("Grayscaling image...")
     return imp.image_gray(image)
 
 
+@ins.traced()
 def image_bin_adaptive_gauss(image, block_size):
     print("Binarizing image (Adaptive Gaussian Binarization)...")
     return imp.image_bin_adaptive_gauss(image, block_size)
 
 
+@ins.traced()
 def invert(image):
     print("Inverting image...")
     return imp.invert(image)
@@ -30,223 +61,708 @@ def display_image(image):
     return imp.display_image(image)
 
 
+def save_debug_image(debug_dir, name, image, color=False):
+    """
+    Debug sink, writes image as PNG to debug directory
+    :param debug_dir: directory images are written to, created if missing
+    :param name: file name without extension
+    :param image:
+    :param color: image is RGB
+    """
+    os.makedirs(debug_dir, exist_ok=True)
+    path = os.path.join(debug_dir, "%s.png" % name)
+    imp.save_image(path, image, color)
+    return path
+
+
+@ins.traced()
 def open_image(image, kernel=None):
     return imo.open_image(image, kernel)
 
 
+@ins.traced()
+def image_subtract(image1, image2, out=None):
+    return imo.image_subtract(image1, image2, out)
+
+
+@ins.traced()
 def open_image_vertically(staff_image, avg_staff_spacing):
     print("Opening staff image with vertical kernel...")
     return imo.open_image_vertically(staff_image, avg_staff_spacing)
 
 
+@ins.traced()
 def find_lines(inv_img):
     print("Finding staff lines...")
     return sl.find_lines(inv_img)
 
 
+@ins.traced()
 def remove_lines(inv_img, lines):
     print("Removing staff lines...")
     return sl.remove_lines(inv_img, lines)
 
 
-def find_regions(org_image, ref_image=None, pixel_span=2, eight_way=True):
-    return irr.find_regions(org_image, ref_image=ref_image, pixel_span=pixel_span, eight_way=eight_way)
+@ins.traced()
+def find_regions(org_image, ref_image=None, pixel_span=2, eight_way=True, features=False):
+    return irr.find_regions(org_image, ref_image=ref_image, pixel_span=pixel_span, eight_way=eight_way,
+                            features=features)
 
 
+@ins.traced()
 def find_vertical_regions(staff_image, img_vert_lines, avg_staff_spacing, pixel_span=1, eight_way=True):
     print("Finding vertical regions...")
     return irr.find_vertical_regions(staff_image, img_vert_lines, avg_staff_spacing,
                                      pixel_span=pixel_span, eight_way=eight_way)
 
 
+@ins.traced()
 def get_bar_lines(regions, vertical_lines, staff):
     print("Classifying bar lines...")
     return mc.get_bar_lines(regions, vertical_lines, staff)
 
 
+@ins.traced()
 def remove_bar_lines(images, bar_lines, regions):
     print("Removing bar lines from staff images and regions...")
     return mc.remove_bar_lines(images, bar_lines, regions)
 
 
-def get_clefs(image, regions, bar_lines):
+@ins.traced()
+def get_clefs(image, regions, bar_lines, **params):
     print("Classifying clefs...")
-    return mc.get_clefs(image, regions, bar_lines)
+    return mc.get_clefs(image, regions, bar_lines, **params)
 
 
+@ins.traced()
 def remove_clefs(images, clefs, regions):
     if len(clefs) > 0:
         print("Removing clefs from staff images and regions...")
         return mc.remove_clefs(images, clefs, regions)
 
 
-def get_time_signatures(staff_image, regions, bar_lines, clefs):
+@ins.traced()
+def get_time_signatures(staff_image, regions, bar_lines, clefs, **params):
     print("Classyfing time signatures...")
-    return mc.get_time_signatures(staff_image, regions, bar_lines, clefs)
+    return mc.get_time_signatures(staff_image, regions, bar_lines, clefs, **params)
 
 
+@ins.traced()
 def remove_time_signatures(images, time_signatures, regions):
     if len(time_signatures) > 0:
         print("Removing time signatures...")
         return mc.remove_time_signatures(images, time_signatures, regions)
 
 
-def get_endings(staff_image, regions, top_staff_line_row):
+@ins.traced()
+def get_endings(staff_image, regions, top_staff_line_row, **params):
     print("Classyfing endings...")
-    return mc.get_endings(staff_image, regions, top_staff_line_row)
+    return mc.get_endings(staff_image, regions, top_staff_line_row, **params)
 
 
+@ins.traced()
 def remove_endings(images, endings, regions):
     if len(endings) > 0:
         print("Removing time signatures...")
         return mc.remove_endings(images, endings, regions)
 
 
-def find_vertical_notes(image, regions, staff, staff_spacing, staff_distance):
+@ins.traced()
+def find_vertical_notes(image, regions, staff, staff_spacing, staff_distance, **params):
     print("Finding notes...")
-    return mc.find_vertical_notes(image, regions, staff, staff_spacing, staff_distance)
+    return mc.find_vertical_notes(image, regions, staff, staff_spacing, staff_distance, **params)
 
 
+@ins.traced()
 def remove_vertical_notes(images, notes, regions):
     return mc.remove_vertical_notes(images, notes, regions)
 
 
-def find_accidentals(image, regions):
+@ins.traced()
+def find_accidentals(image, regions, **params):
     print("Finding accidentals...")
-    return mc.find_accidentals(image, regions)
+    return mc.find_accidentals(image, regions, **params)
 
 
+@ins.traced()
 def remove_accidentals(images, accidentals, regions):
     return mc.remove_accidentals(images, accidentals, regions)
 
 
-def find_dots(image, regions, staff_spacing):
+@ins.traced()
+def find_dots(image, regions, staff_spacing, features=None, **params):
     print("Finding duration dots...")
-    return mc.find_dots(image, regions, staff_spacing)
+    return mc.find_dots(image, regions, staff_spacing, features=features, **params)
 
 
+@ins.traced()
 def remove_dots(images, dots, regions):
     return mc.remove_duration_dots(images, [dot[0] for dot in dots], regions)
 
 
+@ins.traced()
 def remove_ledgers(images, regions, staff, staff_distance):
     return mc.remove_ledgers(images, regions, staff, staff_distance)
 
 
-def find_whole_notes(image, regions, bar_lines, clefs, time_signatures, staff, staff_spacing, staff_distance):
+@ins.traced()
+def find_whole_notes(image, regions, bar_lines, clefs, time_signatures, staff, staff_spacing, staff_distance,
+                     features=None, **params):
     return mc.find_whole_notes(image, regions, bar_lines, clefs, time_signatures,
-                               staff, staff_spacing, staff_distance)
+                               staff, staff_spacing, staff_distance, features=features, **params)
 
 
+@ins.traced()
 def remove_whole_notes(images, whole_notes, regions):
     return mc.remove_whole_notes(images, whole_notes, regions)
 
 
-def find_rests(image, regions, bar_lines):
-    return mc.find_rests(image, regions, bar_lines)
+@ins.traced()
+def find_rests(image, regions, bar_lines, **params):
+    return mc.find_rests(image, regions, bar_lines, **params)
 
 
+@ins.traced()
 def remove_rests(images, rests, regions):
     return mc.remove_whole_notes(images, rests, regions)
 
 
+@ins.traced()
 def export_data(index, bar_lines, clefs, time_signatures, endings, notes,
-                accidentals, dots, whole_notes, rests, staff, staff_spacing, staff_distance):
+                accidentals, dots, whole_notes, rests, staff, staff_spacing, staff_distance, print_results=True):
     print("Exporting data...")
     return mc.export_data(index, bar_lines, clefs, time_signatures, endings, notes,
-                          accidentals, dots, whole_notes, rests, staff, staff_spacing, staff_distance)
+                          accidentals, dots, whole_notes, rests, staff, staff_spacing, staff_distance,
+                          print_results)
+
+
+def get_staff_bounds(staff, avg_staff_distance):
+    staff_image_top = int(staff[0][0] - avg_staff_distance//2)
+    staff_image_bot = int(staff[-1][-1] + avg_staff_distance//2)
+    return staff_image_top, staff_image_bot
+
+
+def _copies(images):
+    return [image.copy() for image in images]
+
+
+_scratch = None
+
+
+def _scratch_image(image):
+    """
+    Image of the same shape and type as image, reused by every call in this process.
+    Only for intermediate images that are not a stage output and are not kept
+    after the stage, since the next call overwrites it.
+    :param image:
+    """
+    global _scratch
+    if _scratch is None or _scratch.shape != image.shape or _scratch.dtype != image.dtype:
+        _scratch = np.empty_like(image)
+    return _scratch
+
+
+def _vertical_lines(staff_image, staff_spacing, pixel_span=1, eight_way=False):
+    img_vert_lines = open_image_vertically(staff_image, staff_spacing)
+    return img_vert_lines, find_regions(img_vert_lines, pixel_span=pixel_span, eight_way=eight_way)[1]
+
+
+def _vertical_regions(staff_image, img_vert_lines, staff_spacing, pixel_span=1, eight_way=True):
+    return find_vertical_regions(staff_image, img_vert_lines, staff_spacing,
+                                 pixel_span=pixel_span, eight_way=eight_way)
+
+
+def _regions(staff_image, pixel_span=2, eight_way=True):
+    return find_regions(staff_image, pixel_span=pixel_span, eight_way=eight_way)[1]
+
+
+def _regions_with_features(staff_image, pixel_span=2, eight_way=True):
+    return find_regions(staff_image, pixel_span=pixel_span, eight_way=eight_way, features=True)[1:]
 
 
+def _bar_line_regions(staff_image, img_vert_lines, staff_spacing, pixel_span=1, eight_way=False):
+    return _vertical_regions(staff_image, img_vert_lines, staff_spacing, pixel_span, eight_way)[1]
+
+
+def _remove_bar_lines(staff_image, img_vert_lines, bar_lines):
+    images = _copies([staff_image, img_vert_lines])
+    remove_bar_lines(images, bar_lines, [])
+    return tuple(images)
+
+
+def _remove_clefs(staff_image, clefs, regions):
+    images, regions = _copies([staff_image]), list(regions)
+    remove_clefs(images, clefs, regions)
+    return images[0], regions
+
+
+def _remove_endings(staff_image, endings, regions):
+    images = _copies([staff_image])
+    remove_endings(images, endings, list(regions))
+    return images[0]
+
+
+def _remove_dots(staff_image, dots, regions):
+    images, regions = _copies([staff_image]), list(regions)
+    remove_dots(images, dots, [regions])
+    return images[0], regions
+
+
+def _wide_objects(staff_image, staff_spacing, factor=3.5, pixel_span=2, eight_way=True):
+    img_vert_lines = imo.open_image_vertically(staff_image, staff_spacing, factor)
+    return _vertical_regions(staff_image, img_vert_lines, staff_spacing, pixel_span, eight_way)[0]
+
+
+def _accidental_regions(staff_image, wide_objects, staff_spacing, factor=1.5, pixel_span=1, eight_way=False):
+    img_vert_lines = imo.open_image_vertically(staff_image, staff_spacing, factor)
+    narrow_objects = image_subtract(staff_image, wide_objects, out=_scratch_image(staff_image))
+    img_vert_objects, regions = _vertical_regions(narrow_objects, img_vert_lines,
+                                                  staff_spacing, pixel_span, eight_way)
+    return img_vert_lines, img_vert_objects, regions
+
+
+def _remove_accidentals(staff_image, accidentals):
+    images = _copies([staff_image])
+    remove_accidentals(images, accidentals, None)
+    return images[0]
+
+
+def _time_signatures(staff_image, regions, bar_lines, clefs, **params):
+    return get_time_signatures(staff_image, regions, bar_lines, [clef[0] for clef in clefs], **params)
+
+
+def _remove_time_signatures(staff_image, img_vert_lines, time_signatures, regions):
+    images = _copies([staff_image, img_vert_lines])
+    remove_time_signatures(images, time_signatures, list(regions))
+    return tuple(images)
+
+
+def _remove_notes(staff_image, notes, regions):
+    images = _copies([staff_image])
+    remove_vertical_notes(images, notes, list(regions))
+    return images[0]
+
+
+def _remove_ledgers(staff_image, regions, staff, staff_distance):
+    images = _copies([staff_image])
+    remove_ledgers(images, list(regions), staff, staff_distance)
+    return images[0]
+
+
+def _remove_rests(staff_image, rests, regions):
+    images = _copies([staff_image])
+    remove_rests(images, [rest[0] for rest in rests], [list(regions)])
+    return images[0]
+
+
+def _whole_notes(staff_image, regions, features, bar_lines, clefs, time_signatures, staff,
+                 staff_spacing, staff_distance, **params):
+    return find_whole_notes(staff_image, regions, bar_lines, [clef[0] for clef in clefs],
+                            [time_signature[0] for time_signature in time_signatures],
+                            staff, staff_spacing, staff_distance, features, **params)
+
+
+def staff_stages():
+    """
+    Stages of staff analysis. Objects are found in order and each kind is
+    removed from the staff image before the next one is looked for, so every
+    stage after a removal depends on it.
+    Parameters of a stage are keyword arguments of its function, e.g. pixel_span
+    of region stages or min_match of classifying stages.
+    """
+    return [
+        sg.Stage('vertical_lines', _vertical_lines, ('staff_image', 'staff_spacing'),
+                 ('img_vert_lines', 'vertical_lines'), {'pixel_span': 1, 'eight_way': False}),
+        sg.Stage('bar_line_regions', _bar_line_regions, ('staff_image', 'img_vert_lines', 'staff_spacing'),
+                 ('bar_line_regions',), {'pixel_span': 1, 'eight_way': False}),
+        sg.Stage('bar_lines', get_bar_lines, ('bar_line_regions', 'vertical_lines', 'staff'), ('bar_lines',)),
+        sg.Stage('bar_line_removal', _remove_bar_lines, ('staff_image', 'img_vert_lines', 'bar_lines'),
+                 ('image_wo_bar_lines', 'vert_lines_wo_bar_lines')),
+        sg.Stage('clef_regions', _vertical_regions,
+                 ('image_wo_bar_lines', 'vert_lines_wo_bar_lines', 'staff_spacing'),
+                 ('clef_objects', 'clef_regions'), {'pixel_span': 3, 'eight_way': True}),
+        sg.Stage('clefs', get_clefs, ('image_wo_bar_lines', 'clef_regions', 'bar_lines'), ('clefs',)),
+        sg.Stage('clef_removal', _remove_clefs, ('image_wo_bar_lines', 'clefs', 'clef_regions'),
+                 ('image_wo_clefs', 'regions_wo_clefs')),
+        sg.Stage('endings', get_endings, ('image_wo_clefs', 'regions_wo_clefs', 'top_staff_line_row'),
+                 ('endings',)),
+        sg.Stage('ending_removal', _remove_endings, ('image_wo_clefs', 'endings', 'regions_wo_clefs'),
+                 ('image_wo_endings',)),
+        sg.Stage('dot_regions', _regions_with_features, ('image_wo_endings',),
+                 ('dot_regions', 'dot_features'), {'pixel_span': 1, 'eight_way': False}),
+        sg.Stage('dots', find_dots, ('image_wo_endings', 'dot_regions', 'staff_spacing', 'dot_features'),
+                 ('dots',)),
+        sg.Stage('dot_removal', _remove_dots, ('image_wo_endings', 'dots', 'dot_regions'),
+                 ('image_wo_dots', 'regions_wo_dots')),
+        sg.Stage('wide_objects', _wide_objects, ('image_wo_dots', 'staff_spacing'), ('wide_objects',),
+                 {'factor': 3.5, 'pixel_span': 2, 'eight_way': True}),
+        sg.Stage('accidental_regions', _accidental_regions, ('image_wo_dots', 'wide_objects', 'staff_spacing'),
+                 ('narrow_vert_lines', 'accidental_objects', 'accidental_regions'),
+                 {'factor': 1.5, 'pixel_span': 1, 'eight_way': False}),
+        sg.Stage('accidentals', find_accidentals, ('accidental_objects', 'accidental_regions'), ('accidentals',)),
+        sg.Stage('accidental_removal', _remove_accidentals, ('image_wo_dots', 'accidentals'),
+                 ('image_wo_accidentals',)),
+        sg.Stage('time_signature_regions', _vertical_regions,
+                 ('image_wo_accidentals', 'narrow_vert_lines', 'staff_spacing'),
+                 ('time_signature_objects', 'time_signature_regions'), {'pixel_span': 2, 'eight_way': True}),
+        sg.Stage('time_signatures', _time_signatures,
+                 ('image_wo_accidentals', 'time_signature_regions', 'bar_lines', 'clefs'), ('time_signatures',)),
+        sg.Stage('time_signature_removal', _remove_time_signatures,
+                 ('image_wo_accidentals', 'narrow_vert_lines', 'time_signatures', 'time_signature_regions'),
+                 ('image_wo_time_signatures', 'vert_lines_wo_time_signatures')),
+        sg.Stage('note_regions', _vertical_regions,
+                 ('image_wo_time_signatures', 'vert_lines_wo_time_signatures', 'staff_spacing'),
+                 ('note_objects', 'note_regions'), {'pixel_span': 4, 'eight_way': True}),
+        sg.Stage('notes', find_vertical_notes,
+                 ('note_objects', 'note_regions', 'staff', 'staff_spacing', 'staff_distance'), ('notes',)),
+        sg.Stage('note_removal', _remove_notes, ('image_wo_time_signatures', 'notes', 'note_regions'),
+                 ('image_wo_notes',)),
+        sg.Stage('ledger_removal', _remove_ledgers,
+                 ('image_wo_notes', 'regions_wo_dots', 'staff', 'staff_distance'), ('image_wo_ledgers',)),
+        sg.Stage('rest_regions', _regions, ('image_wo_ledgers',), ('rest_regions',),
+                 {'pixel_span': 2, 'eight_way': True}),
+        sg.Stage('rests', find_rests, ('image_wo_ledgers', 'rest_regions', 'bar_lines'), ('rests',)),
+        sg.Stage('rest_removal', _remove_rests, ('image_wo_ledgers', 'rests', 'rest_regions'),
+                 ('image_wo_rests',)),
+        sg.Stage('whole_note_regions', _regions_with_features, ('image_wo_rests',),
+                 ('whole_note_regions', 'whole_note_features'), {'pixel_span': 3, 'eight_way': True}),
+        sg.Stage('whole_notes', _whole_notes,
+                 ('image_wo_rests', 'whole_note_regions', 'whole_note_features', 'bar_lines', 'clefs',
+                  'time_signatures', 'staff', 'staff_spacing', 'staff_distance'), ('whole_notes',)),
+    ]
+
+
+def staff_graph(img_wo_lines, staff, avg_staff_spacing, avg_staff_distance):
+    """
+    Stage graph of one staff with its inputs set. After parameters of a stage
+    are changed with set_params, next run only computes that stage and stages
+    that depend on it, e.g.
+        graph = staff_graph(img_wo_lines, staff, spacing, distance)
+        graph.run()
+        graph.set_params('rests', min_match=0.75)
+        rests = graph.run(['rests'])['rests']
+    :param img_wo_lines: image without staff lines
+    :param staff: staff lines of the staff
+    :param avg_staff_spacing: average spacing between staff lines
+    :param avg_staff_distance: average distance between staves
+    :return: StageGraph
+    """
+    staff_image_top, staff_image_bot = get_staff_bounds(staff, avg_staff_distance)
+    graph = sg.StageGraph(staff_stages())
+    graph.set_inputs(staff_image=img_wo_lines[staff_image_top: staff_image_bot].copy(), staff=staff,
+                     staff_spacing=avg_staff_spacing, staff_distance=avg_staff_distance,
+                     top_staff_line_row=staff[0][0] - staff_image_top)
+    return graph
+
+
+@ins.traced()
 def analyze_staff(img_wo_lines, staff, index, avg_staff_spacing, avg_staff_distance):
+    """
+    Recognizes objects of one staff. Works on a copy of the staff strip,
+    so page image is left untouched and staves can be analyzed in any order.
+    :param img_wo_lines: image without staff lines
+    :param staff: staff lines of the staff
+    :param index: index of the staff
+    :param avg_staff_spacing: average spacing between staff lines
+    :param avg_staff_distance: average distance between staves
+    :return: bar lines, clefs, time signatures, endings, notes, accidentals, dots, whole notes and rests
+    """
     print("Analyzing staff %s" % (index + 1))
-    staff_image_top = staff[0][0] - avg_staff_distance//2
-    staff_image_bot = staff[-1][-1] + avg_staff_distance//2
-    staff_image = img_wo_lines[staff_image_top: staff_image_bot]
-    staff_copy = staff_image.copy()
-
-    img_vert_lines = open_image_vertically(staff_image, avg_staff_spacing)
-    vertical_lines = find_regions(img_vert_lines, pixel_span=1, eight_way=False)[1]
-    img_vert_objects, vertical_regions = \
-        find_vertical_regions(staff_image, img_vert_lines,
-                              avg_staff_spacing, pixel_span=1, eight_way=False)
-    bar_lines = get_bar_lines(vertical_regions, vertical_lines, staff)
-    remove_bar_lines([staff_image, img_vert_lines],
-                     bar_lines, [])
-
-    img_vert_objects, vertical_regions = \
-        find_vertical_regions(staff_image, img_vert_lines,
-                              avg_staff_spacing, pixel_span=3)
-    clefs = get_clefs(staff_image, vertical_regions, bar_lines)
-    remove_clefs([staff_image, img_vert_objects, img_vert_lines], clefs, vertical_regions)
-
-    endings = get_endings(staff_image, vertical_regions, staff[0][0] - staff_image_top)
-    remove_endings([staff_image, img_vert_objects, img_vert_lines],
-                   endings, vertical_regions)
-
-    regions = find_regions(staff_image, pixel_span=1, eight_way=False)[1]
-    dots = find_dots(staff_image, regions, avg_staff_spacing)
-    remove_dots([staff_image], dots, [regions])
-
-    img_vert_lines = imo.open_image_vertically(staff_image, avg_staff_spacing, 3.5)
-    img_vert_objects, vertical_regions = \
-        find_vertical_regions(staff_image, img_vert_lines,
-                              avg_staff_spacing, pixel_span=2, eight_way=True)
-
-    img_vert_lines = imo.open_image_vertically(staff_image, avg_staff_spacing, 1.5)
-    img_vert_objects, vertical_regions = \
-        find_vertical_regions(imo.image_subtract(staff_image, img_vert_objects), img_vert_lines,
-                              avg_staff_spacing, pixel_span=1, eight_way=False)
-    accidentals = find_accidentals(img_vert_objects, vertical_regions)
-    remove_accidentals([staff_image], accidentals, None)
-
-    img_vert_objects, vertical_regions = \
-        find_vertical_regions(staff_image, img_vert_lines,
-                              avg_staff_spacing, pixel_span=2)
-    time_signatures = get_time_signatures(staff_image, vertical_regions, bar_lines,
-                                          [clef[0] for clef in clefs])
-    remove_time_signatures([staff_image, img_vert_objects, img_vert_lines],
-                           time_signatures, vertical_regions)
-
-    img_vert_objects, vertical_regions = \
-        find_vertical_regions(staff_image, img_vert_lines,
-                              avg_staff_spacing, pixel_span=4, eight_way=True)
-    notes = find_vertical_notes(img_vert_objects, vertical_regions, staff,
-                                avg_staff_spacing, avg_staff_distance)
-    remove_vertical_notes([staff_image, img_vert_objects, img_vert_lines],
-                          notes, vertical_regions)
-
-    remove_ledgers([staff_image], regions, staff, avg_staff_distance)
-
-    regions = find_regions(staff_image, pixel_span=2)[1]
-    rests = find_rests(staff_image, regions, bar_lines)
-    remove_rests([staff_image], [rest[0] for rest in rests], [regions])
-
-    regions = find_regions(staff_image, pixel_span=3)[1]
-    whole_notes = find_whole_notes(staff_image, regions, bar_lines, [clef[0] for clef in clefs],
-                                   [time_signature[0] for time_signature in time_signatures],
-                                   staff, avg_staff_spacing, avg_staff_distance)
-    remove_whole_notes([staff_image], [note[0] for note in whole_notes], [regions])
-
-    export_data(index, bar_lines, clefs, time_signatures, endings, notes,
-                accidentals, dots, whole_notes, rests, staff, avg_staff_spacing, avg_staff_distance)
-    imp.display_image(staff_copy)
-
-
-def perform_recognition(image_name):
-    org_image = load_image(image_name)
+    ins.annotate(staff=index + 1)
+    results = staff_graph(img_wo_lines, staff, avg_staff_spacing, avg_staff_distance).run(STAFF_OBJECTS)
+    return tuple(results[name] for name in STAFF_OBJECTS)
+
+
+_shared_page = None
+
+
+def _attach_page(name, shape, dtype):
+    global _shared_page
+    # spans are only recorded in the parent process
+    ins.disable(close=False)
+    memory = shared_memory.SharedMemory(name=name)
+    _shared_page = memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def _analyze_shared_staff(args):
+    staff, index, avg_staff_spacing, avg_staff_distance = args
+    return analyze_staff(_shared_page[1], staff, index, avg_staff_spacing, avg_staff_distance)
+
+
+def analyze_staves(img_wo_lines, lines, avg_staff_spacing, avg_staff_distance, workers=1):
+    """
+    Analyzes every staff, yielding results in staff order.
+    With more than one worker, image is put in shared memory and staves are sent to a process pool.
+    :param img_wo_lines: image without staff lines
+    :param lines: staves found on image
+    :param avg_staff_spacing: average spacing between staff lines
+    :param avg_staff_distance: average distance between staves
+    :param workers: number of worker processes, 1 for serial analysis
+    :return: generator of (index, staff, results)
+    """
+    if workers is None or workers <= 1 or len(lines) <= 1:
+        for index, staff in enumerate(lines):
+            yield index, staff, analyze_staff(img_wo_lines, staff, index,
+                                              avg_staff_spacing, avg_staff_distance)
+        return
+
+    memory = shared_memory.SharedMemory(create=True, size=img_wo_lines.nbytes)
+    try:
+        np.ndarray(img_wo_lines.shape, dtype=img_wo_lines.dtype, buffer=memory.buf)[:] = img_wo_lines
+        tasks = [(staff, index, avg_staff_spacing, avg_staff_distance) for index, staff in enumerate(lines)]
+        pool = multiprocessing.Pool(min(workers, len(lines)), _attach_page,
+                                    (memory.name, img_wo_lines.shape, img_wo_lines.dtype.str))
+        for index, results in enumerate(_pool_results(pool, _analyze_shared_staff, tasks)):
+            yield index, lines[index], results
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def _pool_results(pool, function, tasks):
+    """Results of function for tasks in order, pool is closed when all are done"""
+    try:
+        for results in pool.imap(function, tasks):
+            yield results
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+@ins.traced()
+def staff_strip(page, lines, index, avg_staff_distance, avg_thickness=None):
+    print("Removing staff lines from staff %s..." % (index + 1))
+    return li.staff_strip(page, lines, index, avg_staff_distance, avg_thickness)
+
+
+def analyze_page_file_staff(page, lines, index, avg_staff_spacing, avg_staff_distance, avg_thickness=None):
+    """
+    Recognizes objects of one staff of a large image, from its strip only.
+    :param page: binarized li.PageFile with staff lines
+    :param lines: staves found on image
+    :param index: index of the staff
+    :param avg_staff_spacing: average spacing between staff lines
+    :param avg_staff_distance: average distance between staves
+    :param avg_thickness: average thickness of staff lines of the page
+    :return: results of analyze_staff, with regions detached from label maps of the strip
+    """
+    strip, staff = staff_strip(page, lines, index, avg_staff_distance, avg_thickness)
+    return irr.detach_regions(analyze_staff(strip, staff, index, avg_staff_spacing, avg_staff_distance))
+
+
+def _analyze_page_file_staff(args):
+    path, lines, index, avg_staff_spacing, avg_staff_distance, avg_thickness = args
+    return analyze_page_file_staff(li.PageFile(path), lines, index, avg_staff_spacing, avg_staff_distance,
+                                   avg_thickness)
+
+
+def analyze_page_file_staves(page, lines, avg_staff_spacing, avg_staff_distance, workers=1):
+    """
+    analyze_staves for large images. Each staff strip is read from the page file
+    by the process that analyzes the staff, so only strips are kept in memory.
+    :param page: binarized li.PageFile with staff lines
+    :param lines: staves found on image
+    :param avg_staff_spacing: average spacing between staff lines
+    :param avg_staff_distance: average distance between staves
+    :param workers: number of worker processes, 1 for serial analysis
+    :return: generator of (index, staff, results)
+    """
+    avg_thickness = sl.average_thickness(lines)
+    if workers is None or workers <= 1 or len(lines) <= 1:
+        for index, staff in enumerate(lines):
+            yield index, staff, analyze_page_file_staff(page, lines, index, avg_staff_spacing,
+                                                        avg_staff_distance, avg_thickness)
+        return
+
+    tasks = [(page.path, lines, index, avg_staff_spacing, avg_staff_distance, avg_thickness)
+             for index in range(len(lines))]
+    # spans are only recorded in the parent process
+    pool = multiprocessing.Pool(min(workers, len(lines)), ins.disable, (False,))
+    for index, results in enumerate(_pool_results(pool, _analyze_page_file_staff, tasks)):
+        yield index, lines[index], results
+
+
+@ins.traced()
+def binarize(org_image, block_size=9):
     img_gray = image_gray(org_image)
-    img_bin = imp.image_bin_adaptive(img_gray, 9)
-    inv_img = invert(img_bin)
-    lines, line_distances, avg_staff_spacing,\
-        staff_distances, avg_staff_distance = find_lines(inv_img)
-    img_wo_lines = remove_lines(inv_img, lines)
-    for index, staff in enumerate(lines):
-        analyze_staff(img_wo_lines, staff, index, avg_staff_spacing, avg_staff_distance)
-
-for f in os.listdir("test_dataset"):
+    img_bin = imp.image_bin_adaptive(img_gray, block_size)
+    return invert(img_bin)
+
+
+@ins.traced()
+def prepare_page(org_image, stage_cache=None, block_size=9):
+    """
+    Binarizes image, finds staff lines and removes them. With a stage cache,
+    stages already done for the same image are loaded instead.
+    :param org_image: RGB image
+    :param stage_cache: stage_cache.StageCache, None to compute every stage
+    :param block_size: block size of adaptive binarization
+    :return: image without staff lines and results of find_lines
+    """
+    if stage_cache is None:
+        inv_img = binarize(org_image, block_size)
+        found_lines = find_lines(inv_img)
+        return remove_lines(inv_img, found_lines[0]), found_lines
+
+    binarize_key = stage_cache.key('binarize', [org_image], {'block_size': block_size})
+    lines_key = stage_cache.key('find_lines', [binarize_key])
+    remove_key = stage_cache.key('remove_lines', [lines_key])
+    lines_entry = stage_cache.load(lines_key)
+    remove_entry = stage_cache.load(remove_key) if lines_entry is not None else None
+    if remove_entry is not None:
+        return remove_entry['image'], tuple(lines_entry[sc.JSON_KEY])
+
+    binarize_entry = stage_cache.load(binarize_key)
+    if binarize_entry is not None:
+        inv_img = binarize_entry['image']
+    else:
+        inv_img = binarize(org_image, block_size)
+        stage_cache.store(binarize_key, image=inv_img)
+    if lines_entry is not None:
+        found_lines = tuple(lines_entry[sc.JSON_KEY])
+    else:
+        found_lines = find_lines(inv_img)
+        stage_cache.store(lines_key, list(found_lines))
+    img_wo_lines = remove_lines(inv_img, found_lines[0])
+    stage_cache.store(remove_key, image=img_wo_lines)
+    return img_wo_lines, found_lines
+
+
+@ins.traced()
+def prepare_large_page(gray_page, directory, block_size=9, band_height=li.BAND_HEIGHT):
+    """
+    Binarizes grayscale page and finds staff lines, band by band.
+    Staff lines are removed later, from each staff strip.
+    :param gray_page: li.PageFile
+    :param directory: directory binarized page is written to
+    :param block_size: block size of adaptive binarization
+    :param band_height: rows of a band
+    :return: binarized li.PageFile and results of find_lines
+    """
+    print("Binarizing image in bands...")
+    binarized = li.binarize(gray_page, os.path.join(directory, "binarized.npy"), block_size, band_height)
+    print("Finding staff lines in bands...")
+    return binarized, li.find_lines(binarized, band_height)
+
+
+def iter_recognize_large(image, workers=1, band_height=li.BAND_HEIGHT):
+    """
+    iter_recognize in large image mode. Page files are written to a temporary directory.
+    :param image: path to the image or grayscale li.PageFile
+    :param workers: number of worker processes for staff analysis, 1 for serial analysis
+    :param band_height: rows of a band
+    :return: generator of StaffResult, in staff order
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        gray_page = li.load_gray(image, directory, band_height) if isinstance(image, str) else image
+        page, found_lines = prepare_large_page(gray_page, directory, band_height=band_height)
+        lines, line_distances, avg_staff_spacing,\
+            staff_distances, avg_staff_distance = found_lines
+        for index, staff, results in analyze_page_file_staves(page, lines, avg_staff_spacing,
+                                                              avg_staff_distance, workers):
+            yield StaffResult(index, staff, *results, avg_staff_spacing, avg_staff_distance)
+
+
+def iter_recognize(image, workers=1, stage_cache=None, band_height=None):
+    """
+    Recognizes music objects on image, yielding results of each staff as soon as it is analyzed.
+    :param image: path to the image, loaded RGB image or grayscale li.PageFile
+    :param workers: number of worker processes for staff analysis, 1 for serial analysis
+    :param stage_cache: stage_cache.StageCache for page stages and label maps, None to compute every stage.
+    In large image mode only label maps are cached.
+    :param band_height: rows of a band in large image mode, which is used when it is given or image is
+    a PageFile. None to process the whole page at once.
+    :return: generator of StaffResult, in staff order
+    """
+    large = band_height is not None or isinstance(image, li.PageFile)
+    org_image = load_image(image) if isinstance(image, str) and not large else image
+    previous_cache = sc.activate(stage_cache)
     try:
-        print("File: %s" % f)
-        perform_recognition("test_dataset/%s" % f)
-    except Exception as e:
-        print("ERROR!")
-        print(e)
+        if large:
+            for result in iter_recognize_large(org_image, workers, band_height or li.BAND_HEIGHT):
+                yield result
+            return
+        img_wo_lines, found_lines = prepare_page(org_image, stage_cache)
+        lines, line_distances, avg_staff_spacing,\
+            staff_distances, avg_staff_distance = found_lines
+        for index, staff, results in analyze_staves(img_wo_lines, lines, avg_staff_spacing,
+                                                    avg_staff_distance, workers):
+            yield StaffResult(index, staff, *results, avg_staff_spacing, avg_staff_distance)
+    finally:
+        sc.activate(previous_cache)
+
+
+@contextlib.contextmanager
+def open_page(image_name, band_height=None):
+    """
+    Loads image as RGB image, or in large image mode as grayscale
+    li.PageFile in a temporary directory, removed on exit
+    :param image_name: path to the image
+    :param band_height: rows of a band in large image mode, None to load whole image
+    """
+    if band_height is None:
+        yield load_image(image_name)
+        return
+    print("Loading image: %s" % image_name)
+    with tempfile.TemporaryDirectory() as directory:
+        yield li.load_gray(image_name, directory, band_height)
+
+
+@ins.traced()
+def perform_recognition(image_name, workers=1, display=False, debug_dir=None, writers=(), print_results=True,
+                        stage_cache=None, band_height=None, results=None):
+    """
+    Recognizes music objects on image and exports them staff by staff.
+    :param image_name: path to the image
+    :param workers: number of worker processes for staff analysis, 1 for serial analysis
+    :param display: display each staff after its data is exported, needs matplotlib
+    :param debug_dir: directory each staff is written to as PNG, None to write nothing
+    :param writers: music_export writers each staff is written to
+    :param print_results: print data of each staff
+    :param stage_cache: stage_cache.StageCache for page stages and label maps, None to compute every stage
+    :param band_height: rows of a band in large image mode, see large_image, None to process whole page.
+    Staff images are then grayscale.
+    :param results: list StaffResult of each staff is appended to, None to keep none.
+    Staves are only kept for writers while they are written, so without results
+    memory used does not grow with number of staves.
+    :return: list of count_objects of each staff, in staff order
+    """
+    ins.annotate(image=image_name)
+    image_base_name = os.path.splitext(os.path.basename(image_name))[0]
+    page = me.Page(image_name)
+    for writer in writers:
+        writer.begin_page(page)
+    staves = []
+    with open_page(image_name, band_height) as org_image:
+        for result in iter_recognize(org_image, workers, stage_cache, band_height):
+            staff_data = export_data(result.index, result.bar_lines, result.clefs, result.time_signatures,
+                                     result.endings, result.notes, result.accidentals, result.dots,
+                                     result.whole_notes, result.rests, result.staff,
+                                     result.staff_spacing, result.staff_distance, print_results)
+            for writer in writers:
+                writer.write_staff(staff_data)
+            if display or debug_dir is not None:
+                staff_image_top, staff_image_bot = get_staff_bounds(result.staff, result.staff_distance)
+                if band_height is None:
+                    staff_image = org_image[staff_image_top: staff_image_bot]
+                else:
+                    staff_image = np.array(org_image.rows(staff_image_top, staff_image_bot))
+                if debug_dir is not None:
+                    save_debug_image(debug_dir, "%s_staff_%02d" % (image_base_name, result.index + 1),
+                                     staff_image, color=band_height is None)
+                if display:
+                    display_image(staff_image)
+            staves.append(count_objects(result))
+            if results is not None:
+                results.append(result)
+    for writer in writers:
+        writer.end_page()
+    return staves
+
+
+if __name__ == "__main__":
+    import batch
+    sys.exit(batch.run(sys.argv[1:] or ["test_dataset"]))
@@ -0,0 +1,194 @@
+import struct
+import music_export as me
+
+
+SEMITONES = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+DRUM_CHANNEL = 9
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+PROGRAM_CHANGE = 0xC0
+META = 0xFF
+META_TEMPO = 0x51
+META_TIME_SIGNATURE = 0x58
+META_KEY_SIGNATURE = 0x59
+META_END_OF_TRACK = 0x2F
+
+
+def midi_number(step, octave, alteration=0):
+    """
+    :param step: note name, e.g. 'C'
+    :param octave: octave, 4 for middle C
+    :param alteration: semitones, 1 for sharp, -1 for flat
+    :return: MIDI note number, 60 for middle C
+    """
+    return 12 * (octave + 1) + SEMITONES[step] + alteration
+
+
+def variable_length(value):
+    """Encodes number as MIDI variable length quantity
+    :param value:
+    """
+    data = [value & 0x7F]
+    value >>= 7
+    while value > 0:
+        data.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(data)
+
+
+def part_channel(part):
+    """MIDI channel of a part, drum channel is skipped
+    :param part: index of staff in system
+    """
+    channel = part if part < DRUM_CHANNEL else part + 1
+    if channel > 15:
+        raise Exception("Too many parts for MIDI channels: %s" % (part + 1))
+    return channel
+
+
+class MidiWriter(me.ResultWriter):
+    """Writes staves as a format 0 Standard MIDI File, with one channel per part.
+    Staves of a system are merged: staff k of every system is part k, and all
+    parts of a system start together. Only one system is kept in memory, it is
+    written out once the next system starts. Track length is written on close,
+    so output has to be seekable. Repeats and endings are not unrolled.
+    """
+
+    def __init__(self, output, staves_per_system=1, ticks_per_quarter=480, tempo=120,
+                 velocity=80, programs=None):
+        """
+        :param output: path or seekable binary file object
+        :param staves_per_system: number of staves in a system, e.g. 2 for piano
+        :param ticks_per_quarter: MIDI ticks of a quarter note
+        :param tempo: quarter notes per minute
+        :param velocity: velocity of notes
+        :param programs: General MIDI program of each part, defaults to piano
+        """
+        if isinstance(output, str):
+            output = open(output, 'wb')
+            me.ResultWriter.__init__(self, output)
+            self.owns_file = True
+        else:
+            me.ResultWriter.__init__(self, output)
+        self.staves_per_system = staves_per_system
+        self.ticks_per_quarter = ticks_per_quarter
+        self.velocity = velocity
+        self.programs = programs or [0] * staves_per_system
+        self.system = None
+        self.system_staves = []
+        self.system_start = 0
+        self.last_tick = 0
+        self.pitches = [me.PitchTracker() for _ in range(staves_per_system)]
+
+        self.file.write(struct.pack('>4sLHHH', b'MThd', 6, 0, 1, ticks_per_quarter))
+        self.file.write(b'MTrk')
+        self.length_position = self.file.tell()
+        self.file.write(struct.pack('>L', 0))
+        self.track_length = 0
+
+        self.write_event(0, struct.pack('>BBB', META, META_TEMPO, 3) +
+                         struct.pack('>L', int(60000000 // tempo))[1:])
+        for part in range(staves_per_system):
+            channel = part_channel(part)
+            self.write_event(0, struct.pack('>BB', PROGRAM_CHANGE | channel, self.programs[part]))
+
+    def write_event(self, tick, data):
+        chunk = variable_length(tick - self.last_tick) + data
+        self.file.write(chunk)
+        self.track_length += len(chunk)
+        self.last_tick = tick
+
+    def begin_page(self, page):
+        self.flush_system()
+        me.ResultWriter.begin_page(self, page)
+
+    def write_staff(self, staff):
+        system = staff.index // self.staves_per_system
+        if system != self.system:
+            self.flush_system()
+            self.system = system
+        self.system_staves += [staff]
+
+    def end_page(self):
+        self.flush_system()
+        me.ResultWriter.end_page(self)
+
+    def duration_ticks(self, event):
+        duration = float(event.duration) * 4 * self.ticks_per_quarter
+        if event.prolonged:
+            duration *= 1.5
+        return int(round(duration))
+
+    def staff_events(self, staff, part):
+        """
+        :param staff: music_export.Staff
+        :param part: index of staff in system
+        :return: list of (tick, order, data) relative to system start, and end tick of staff
+        """
+        channel = part_channel(part)
+        pitches = self.pitches[part]
+        events = []
+        tick = 0
+        for measure in staff.measures:
+            pitches.start_measure(measure)
+            if part == 0:
+                events += self.measure_meta_events(tick, measure)
+            chord_column = None
+            chord_end = tick
+            for event in measure.events:
+                if event.kind == me.Event.STEM_NOTE and event.column == chord_column:
+                    start = chord_start
+                else:
+                    tick = chord_end
+                    start = tick
+                    chord_start = start
+                    chord_column = event.column if event.kind == me.Event.STEM_NOTE else None
+                end = start + self.duration_ticks(event)
+                chord_end = max(chord_end, end)
+                if not event.is_rest:
+                    note = midi_number(*pitches.pitch(event))
+                    if 0 <= note < 128:
+                        events += [(start, 2, struct.pack('>BBB', NOTE_ON | channel, note, self.velocity)),
+                                   (end, 0, struct.pack('>BBB', NOTE_OFF | channel, note, 0))]
+            tick = chord_end
+        return events, tick
+
+    def measure_meta_events(self, tick, measure):
+        events = []
+        time = me.parse_time(measure.time) if measure.time is not None else None
+        if time is not None:
+            beats, beat_type, symbol = time
+            events += [(tick, 1, struct.pack('>BBBBBBB', META, META_TIME_SIGNATURE, 4, beats,
+                                             beat_type.bit_length() - 1, 24, 8))]
+        if len(measure.key) > 0:
+            events += [(tick, 1, struct.pack('>BBBbB', META, META_KEY_SIGNATURE, 2,
+                                             me.key_fifths(measure.key), 0))]
+        return events
+
+    def flush_system(self):
+        """Merges buffered staves of current system and writes them out"""
+        if len(self.system_staves) == 0:
+            return
+        events = []
+        system_end = 0
+        for staff in self.system_staves:
+            part = staff.index % self.staves_per_system
+            staff_events, staff_end = self.staff_events(staff, part)
+            events += staff_events
+            system_end = max(system_end, staff_end)
+        for tick, order, data in sorted(events, key=lambda event: (event[0], event[1])):
+            self.write_event(self.system_start + tick, data)
+        self.system_start += system_end
+        self.system_staves = []
+        self.system = None
+
+    def close(self):
+        self.flush_system()
+        self.write_event(self.last_tick, struct.pack('>BBB', META, META_END_OF_TRACK, 0))
+        end_position = self.file.tell()
+        self.file.seek(self.length_position)
+        self.file.write(struct.pack('>L', self.track_length))
+        self.file.seek(end_position)
+        me.ResultWriter.close(self)
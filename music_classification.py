@@ -1,53 +1,68 @@
+import numpy as np
 import template_matching as tm
 import image_region_recognition as irr
 import image_operations as imo
-import image_processing as imp
+import music_export as me
+import instrumentation as ins
 
 
 def open_image(image, kernel=None):
     return imo.open_image(image, kernel)
 
 
-def merge_images(images):
-    return imo.merge_images(images)
+def merge_images(images, out=None):
+    return imo.merge_images(images, out)
 
 
 def find_regions(org_image, ref_image=None, pixel_span=2, eight_way=True):
     return irr.find_regions(org_image, ref_image, pixel_span, eight_way=eight_way)
 
 
-def search_for_templates(template_filepaths):
-    return tm.search_for_templates(template_filepaths)
+def search_for_templates(template_filepaths, template_catalogue=None):
+    return tm.search_for_templates(template_filepaths, template_catalogue)
 
 
+@ins.traced()
 def template_match(obj,
                    template_filepaths=None,
                    template_images=None,
                    resize=False,
-                   print_results=True):
+                   print_results=True,
+                   matching=tm.BOUNDED_MATCHING,
+                   template_library=None,
+                   min_match=0):
     return tm.template_match(obj,
                              template_filepaths=template_filepaths,
                              template_images=template_images,
                              resize=resize,
-                             print_results=print_results)
+                             print_results=print_results,
+                             matching=matching,
+                             template_library=template_library,
+                             min_match=min_match)
+
+
+def make_template_images(template_filepaths, size=None, template_library=None):
+    return tm.make_template_images(template_filepaths, size, template_library)
 
 
 def get_region_image(image, region):
     return irr.get_region_image(image, region)
 
 
-def get_bar_lines(regions, vertical_lines, staff):
+def region_features(regions):
+    return irr.region_features(regions)
+
+
+def get_bar_lines(regions, vertical_lines, staff, features=None):
+    if features is None:
+        features = region_features(regions)
+    staff_height = staff[-1][-1] - staff[0][0]
+    heights = features['bottom'] - features['top']
+    candidates = sorted([regions[index] for index in np.flatnonzero(heights == staff_height)])
     bar_lines = []
-    regions = sorted(regions)
-    vertical_lines = sorted(vertical_lines)
-    for region in regions:
+    for region in candidates:
         if region in vertical_lines:
-            min_row = min([r for r, c in region])
-            max_row = max([r for r, c in region])
-            height = max_row - min_row
-            staff_height = staff[-1][-1] - staff[0][0]
-            if height == staff_height:
-                bar_lines += [region]
+            bar_lines += [region]
     return bar_lines
 
 
@@ -58,19 +73,19 @@ def remove_bar_lines(images, bar_lines, regions):
 def get_clefs(staff_image, regions, bar_lines, min_match=0.75):
     template_filepaths = None
     clefs = []
+    regions_index = irr.RegionIndex(regions)
     for index in range(len(bar_lines) - 1):
         bar_line = bar_lines[index]
-        bar_line_height = max([r for r, c in bar_line]) - min([r for r, c in bar_line]) + 1
-        closest_region, closest_col, closest_index = find_closest_region(bar_line, regions)
+        bar_line_height = bar_line.bottom - bar_line.top + 1
+        closest_region, closest_col, closest_index = find_closest_region(bar_line, regions, index=regions_index)
         if closest_region is not None and check_region_location(bar_line, bar_lines[index + 1],
                                                                 closest_region, bar_line_height / 4.):
-            reg_height, reg_width = get_region_image(staff_image, closest_region).shape[:2]
-            if reg_height > bar_line_height / 2.:
+            if closest_region.height > bar_line_height / 2.:
                 if template_filepaths is None:
                     template_filepaths = search_for_templates("clefs")
                 best_match = template_match(get_region_image(staff_image, closest_region),
                                             template_filepaths=template_filepaths,
-                                            resize=True, print_results=False)
+                                            resize=True, print_results=False, min_match=min_match)
                 if min_match <= best_match[1]:
                     clefs += [(closest_region, best_match)]
     return clefs
@@ -87,27 +102,24 @@ def remove_white_pixels(images=None, white_regions=None, regions_list=None):
         images = []
     if white_regions is None:
         white_regions = []
-    for white_region in white_regions:
-        for regions in regions_list:
-            if white_region in regions:
-                regions.remove(white_region)
-        for img in images:
-            for r, c in white_region:
-                img[r][c] = 0
+    for regions in regions_list:
+        irr.drop_regions(regions, white_regions)
+    irr.erase_regions(images, white_regions)
 
 
-def find_closest_region(ref_region, regions, exceptions=None):
+def find_closest_region(ref_region, regions, exceptions=None, index=None):
+    if index is not None:
+        return index.closest_right_of(ref_region.right, exceptions)
     if exceptions is None:
         exceptions = []
-    max_ref_reg_col = max([c for r, c in ref_region])
+    max_ref_reg_col = ref_region.right
     closest_region = None
     closest_col = -1
     closest_index = -1
     for index, region in enumerate(regions):
         if region not in exceptions:
-            reg_cols = [c for r, c in region if c > max_ref_reg_col]
-            if len(reg_cols) > 0 and len(reg_cols) == len(region):
-                min_clef_col = min(reg_cols)
+            if len(region) > 0 and region.left > max_ref_reg_col:
+                min_clef_col = region.left
                 if min_clef_col < closest_col or closest_col == -1:
                     closest_col = min_clef_col
                     closest_region = region
@@ -116,9 +128,9 @@ def find_closest_region(ref_region, regions, exceptions=None):
 
 
 def check_region_location(start_region, end_region, region, staff_spacing, factor=2.5):
-    max_start_reg_col = max([c for r, c in start_region])
-    min_end_reg_col = max([c for r, c in end_region])
-    min_reg_col = min([c for r, c in region])
+    max_start_reg_col = start_region.right
+    min_end_reg_col = end_region.right
+    min_reg_col = region.left
     distance = min_reg_col - max_start_reg_col
     return (factor == 0 or staff_spacing == 0 or distance <= staff_spacing * factor) and min_reg_col < min_end_reg_col
 
@@ -126,23 +138,26 @@ def check_region_location(start_region, end_region, region, staff_spacing, facto
 def get_time_signatures(staff_image, regions, bar_lines, clefs, min_match=0.7, tolerance=0):
     template_filepaths = None
     time_signatures = []
+    regions_index = irr.RegionIndex(regions)
+    clefs_index = irr.RegionIndex(clefs)
     for index in range(len(bar_lines) - 1):
         bar_line = bar_lines[index]
-        bar_line_top = min([r for r, c in bar_line])
-        bar_line_bot = max([r for r, c in bar_line])
+        bar_line_top = bar_line.top
+        bar_line_bot = bar_line.bottom
         bar_line_height = bar_line_bot - bar_line_top + 1
-        closest_clef, closest_clef_col, closest_index = find_closest_region(bar_line, clefs)
+        closest_clef, closest_clef_col, closest_index = find_closest_region(bar_line, clefs, index=clefs_index)
         if closest_clef is not None and check_region_location(bar_line, bar_lines[index + 1],
                                                               closest_clef, bar_line_height / 4.):
             start_region = closest_clef
         else:
             start_region = bar_line
-        closest_region, closest_col, closest_index = find_closest_region(start_region, regions)
+        closest_region, closest_col, closest_index = find_closest_region(start_region, regions,
+                                                                         index=regions_index)
 
         if closest_region is not None and check_region_location(start_region, bar_lines[index + 1],
                                                                 closest_region, 0):
-            closest_region_top = min([r for r, c in closest_region])
-            closest_region_bot = max([r for r, c in closest_region])
+            closest_region_top = closest_region.top
+            closest_region_bot = closest_region.bottom
             closest_region_height = closest_region_bot - closest_region_top + 1
 
             if closest_region_top >= bar_line_top - tolerance and closest_region_bot <= bar_line_bot + tolerance:
@@ -153,20 +168,20 @@ def get_time_signatures(staff_image, regions, bar_lines, clefs, min_match=0.7, t
                     # Time signature's top and bottom numbers are recognized as one region, they need to be split
                     region_image = get_region_image(staff_image, closest_region)
                     full_region_image = region_image
-                    region_images = [region_image[:bar_line_height / 2], region_image[bar_line_height / 2:]]
+                    region_images = [region_image[:bar_line_height // 2], region_image[bar_line_height // 2:]]
                 else:
                     # Time signature's top and bottom numbers are separate regions, get another one
                     closest_region_copy = closest_region[:]
                     closest_region_top_copy = closest_region_top
-                    closest_region_right_copy = max([c for r, c in closest_region])
+                    closest_region_right_copy = closest_region.right
                     closest_region, closest_col, closest_index = \
-                        find_closest_region(start_region, regions, [closest_region])
+                        find_closest_region(start_region, regions, [closest_region], regions_index)
                     if closest_region is not None and \
                             check_region_location(start_region, bar_lines[index + 1],
                                                   closest_region, 0):
-                        closest_region_top = min([r for r, c in closest_region])
-                        closest_region_bot = max([r for r, c in closest_region])
-                        closest_region_left = min([c for r, c in closest_region])
+                        closest_region_top = closest_region.top
+                        closest_region_bot = closest_region.bottom
+                        closest_region_left = closest_region.left
                         closest_region_height = closest_region_bot - closest_region_top + 1
                         if closest_region_left < closest_region_right_copy and \
                                 closest_region_top >= bar_line_top - tolerance and \
@@ -237,14 +252,14 @@ def get_endings(staff_image, regions, top_staff_line_row, min_match=0.9):
     template_filepaths = None
     endings = []
     for region in regions:
-        region_bot_row = max([r for r, c in region])
+        region_bot_row = region.bottom
         if region_bot_row < top_staff_line_row:
             if template_filepaths is None:
                 template_filepaths = search_for_templates("endings")
                 best_match = template_match(get_region_image(staff_image, region),
                                             template_filepaths=template_filepaths,
                                             resize=True, print_results=False)
-                if best_match >= min_match:
+                if best_match[1] >= min_match:
                     endings += [(region, best_match)]
     return endings
 
@@ -257,7 +272,7 @@ def find_avg_thickness(vertical_lines):
     avg_vert_line_thickness = 0
     if len(vertical_lines) > 0:
         for line in vertical_lines:
-            avg_vert_line_thickness += max([c for r, c in line]) - min([c for r, c in line]) + 1
+            avg_vert_line_thickness += line.right - line.left + 1
         avg_vert_line_thickness *= 1. / len(vertical_lines)
     return avg_vert_line_thickness
 
@@ -273,28 +288,16 @@ def find_vertical_notes(org_image, regions, staff, staff_spacing, staff_distance
     unrecognized_regions = []
     small_regions = []
 
-    note_heads_templates = {}
-    for templateName in search_for_templates(["note_heads/filled"]):
-        template = imp.load_image(templateName)
-        template = imp.resize_image(template, (int(round(staff_spacing)), int(round(staff_spacing))))
-        template = imp.image_gray(template)
-        template = imp.image_bin_otsu(template)
-        template = imp.invert(template)
-        note_heads_templates[templateName] = template
-
-    half_note_heads_templates = {}
-
-    for templateName in search_for_templates(["note_heads/half", "note_heads/whole"]):
-        template = imp.load_image(templateName)
-        template = imp.resize_image(template, (int(round(staff_spacing)), int(round(staff_spacing))))
-        template = imp.image_gray(template)
-        template = imp.image_bin_otsu(template)
-        template = imp.invert(template)
-        half_note_heads_templates[templateName] = template
+    note_head_size = (int(round(staff_spacing)), int(round(staff_spacing)))
+    note_heads_templates = make_template_images(search_for_templates(["note_heads/filled"]),
+                                                note_head_size)
+    half_note_heads_templates = make_template_images(search_for_templates(["note_heads/half",
+                                                                           "note_heads/whole"]),
+                                                     note_head_size)
 
     for index, region in enumerate(regions):
-        org_reg_c = min([c for r, c in region])
-        org_reg_r = min([r for r, c in region])
+        org_reg_c = region.left
+        org_reg_r = region.top
         region_image = irr.get_region_image(image, region)
         if len(region_image) > 3 * staff_spacing:
             img_vert_lines = imo.open_image_vertically(region_image, staff_spacing, 3)
@@ -316,11 +319,11 @@ def find_vertical_notes(org_image, regions, staff, staff_spacing, staff_distance
                 start_vert_line = None
                 end_vert_line = None
                 lines = []
-                min_col = min([c for r, c in sub_region])
-                max_col = max([c for r, c in sub_region])
+                min_col = sub_region.left
+                max_col = sub_region.right
                 for line in vertical_lines:
-                    min_line_col = min([c for r, c in line])
-                    max_line_col = max([c for r, c in line])
+                    min_line_col = line.left
+                    max_line_col = line.right
                     if -tolerance <= min_col - max_line_col <= tolerance:
                         start_vert_line = line
                         lines += [line]
@@ -341,15 +344,16 @@ def find_vertical_notes(org_image, regions, staff, staff_spacing, staff_distance
             print("Finding half beams...")
             half_beams = []
             for sub_region in connected_regions:
-                max_row = max([r for r, c in sub_region[0]])
-                min_row = min([r for r, c in sub_region[0]])
-                min_col = min([c for r, c in sub_region[0]])
-                max_col = max([c for r, c in sub_region[0]])
+                max_row = sub_region[0].bottom
+                min_row = sub_region[0].top
+                min_col = sub_region[0].left
+                max_col = sub_region[0].right
                 for beam in full_beams:
                     if sub_region[1] in beam[3]:
                         try:
-                            min_beam_row = min([r for r, c in beam[0] if min_col <= c <= max_col])
-                            max_beam_row = max([r for r, c in beam[0] if min_col <= c <= max_col])
+                            beam_rows = beam[0].rows[(min_col <= beam[0].cols) & (beam[0].cols <= max_col)]
+                            min_beam_row = beam_rows.min()
+                            max_beam_row = beam_rows.max()
                         except ValueError:
                             continue
                         distance = None
@@ -371,7 +375,7 @@ def find_vertical_notes(org_image, regions, staff, staff_spacing, staff_distance
             for sub_region in connected_regions:
                 best_match = template_match(get_region_image(region_image, sub_region[0]),
                                             template_filepaths=flag_templates,
-                                            resize=True, print_results=False)
+                                            resize=True, print_results=False, min_match=flag_min_match)
                 if flag_min_match <= best_match[1]:
                     flags += [(sub_region, best_match)]
 
@@ -394,21 +398,21 @@ def find_vertical_notes(org_image, regions, staff, staff_spacing, staff_distance
                 min_r -= org_reg_r
                 min_r = int(min_r)
 
-                max_r = max([r for r, c in connected_region[0]])
+                max_r = connected_region[0].bottom
                 for start_r in range(min_r, max_r, int(staff_spacing // 2)):
-                    sub_region = [value for value in connected_region[0]
-                                  if start_r + staff_spacing >= value[0] >= start_r]
+                    sub_region = connected_region[0].rows_between(start_r, start_r + staff_spacing)
                     if len(sub_region) > 0:
                         sub_region_img = get_region_image(region_image, sub_region)
                         best_match = template_match(sub_region_img,
                                                     template_images=note_heads_templates,
-                                                    print_results=False)
+                                                    print_results=False, min_match=note_head_min_match)
                         if note_head_min_match <= best_match[1]:
                             note_heads += [(sub_region, connected_region, line_index, best_match)]
                         else:
                             best_match = template_match(sub_region_img,
                                                         template_images=half_note_heads_templates,
-                                                        print_results=False)
+                                                        print_results=False,
+                                                        min_match=half_note_head_min_match)
                             if half_note_head_min_match <= best_match[1]:
                                 note_heads += [(sub_region, connected_region, line_index,
                                                 ("templates/note_heads/half_01", best_match[1]))]
@@ -436,7 +440,7 @@ def find_vertical_notes(org_image, regions, staff, staff_spacing, staff_distance
                         flags_and_beams += 1
                 for flag, flag_match in flags:
                     if line == flag[1]:
-                        flags_and_beams += int(flag_match[0].split('/')[-1].split('_')[0]) / 8
+                        flags_and_beams += int(flag_match[0].split('/')[-1].split('_')[0]) // 8
                         checked_flags += [(flag, flag_match)]
 
                 if flags_and_beams > 0:
@@ -446,7 +450,7 @@ def find_vertical_notes(org_image, regions, staff, staff_spacing, staff_distance
                 else:
                     duration = 1 / 4. if note_head_type == "filled" else 0.5
 
-                notes += [(min([c for r, c in connected_region[0]]), height, note_head_type, duration)]
+                notes += [(connected_region[0].left, height, note_head_type, duration)]
 
             for flag in flags:
                 if flag not in checked_flags:
@@ -463,18 +467,18 @@ def find_vertical_notes(org_image, regions, staff, staff_spacing, staff_distance
                     min_r -= org_reg_r
                     min_r = int(min_r)
 
-                    max_r = max([r for r, c in connected_region[0]])
+                    max_r = connected_region[0].bottom
                     for start_r in range(min_r, max_r, int(staff_spacing // 2)):
-                        sub_region = [value for value in connected_region[0]
-                                      if start_r + staff_spacing >= value[0] >= start_r]
+                        sub_region = connected_region[0].rows_between(start_r, start_r + staff_spacing)
                         if len(sub_region) > 0:
                             best_match = template_match(get_region_image(region_image,sub_region),
                                                         template_images=half_note_heads_templates,
-                                                        print_results=False)
+                                                        print_results=False,
+                                                        min_match=half_note_head_min_match)
                             if half_note_head_min_match <= best_match[1]:
                                 note_heads += [(sub_region, connected_region, line_index,
                                                 ("templates/note_heads/half_01", best_match[1]))]
-                                notes += [(min([c for r, c in connected_region[0]]), line_index, "half", 0.5)]
+                                notes += [(connected_region[0].left, line_index, "half", 0.5)]
                         line_index += 0.5
 
             notes = sorted(notes)
@@ -528,7 +532,7 @@ def find_accidentals(org_image, regions, min_match=0.7):
         region_image = irr.get_region_image(org_image, region)
         best_match = template_match(region_image,
                                     template_filepaths=template_filepaths,
-                                    resize=True, print_results=False)
+                                    resize=True, print_results=False, min_match=min_match)
         if min_match <= best_match[1]:
             accidentals += [(region, best_match)]
     return accidentals
@@ -538,22 +542,20 @@ def remove_accidentals(images, accidentals, regions):
     return remove_white_pixels(images, [accidental[0] for accidental in accidentals], regions)
 
 
-def find_dots(image, regions, staff_spacing, tolerance=2):
-    dots = []
-
-    for region in regions:
-        region_image = get_region_image(image, region)
-        height, width = region_image.shape[:2]
-        if height <= staff_spacing / 2 + tolerance and width <= staff_spacing / 2 + tolerance:
-            dots += [(region, None)]
-    return dots
+def find_dots(image, regions, staff_spacing, tolerance=2, features=None):
+    if features is None:
+        features = region_features(regions)
+    heights = features['bottom'] - features['top'] + 1
+    widths = features['right'] - features['left'] + 1
+    selected = (heights <= staff_spacing / 2 + tolerance) & (widths <= staff_spacing / 2 + tolerance)
+    return [(regions[index], None) for index in np.flatnonzero(selected)]
 
 
 def remove_duration_dots(images, dots, regions):
     return remove_white_pixels(images, dots, regions)
 
 
-def remove_ledgers(images, regions, staff, staff_distance, tolerance=1):
+def remove_ledgers(images, regions, staff, staff_distance, tolerance=1, features=None):
     avg_line_thickness = 0
     for line in staff:
         avg_line_thickness += line[-1] - line[0] + 1
@@ -561,14 +563,12 @@ def remove_ledgers(images, regions, staff, staff_distance, tolerance=1):
 
     rel_staff = get_rel_staff(staff, staff_distance)
 
-    regions_to_remove = []
-    for region in regions:
-        region_top = min([r for r, c in region])
-        region_bot = max([r for r, c in region])
-        region_height = region_bot - region_top + 1
-        if avg_line_thickness + tolerance > region_height and \
-                (region_bot < rel_staff[0][0] or region_top > rel_staff[-1][-1]):
-            regions_to_remove += [region]
+    if features is None:
+        features = region_features(regions)
+    heights = features['bottom'] - features['top'] + 1
+    selected = (avg_line_thickness + tolerance > heights) & \
+        ((features['bottom'] < rel_staff[0][0]) | (features['top'] > rel_staff[-1][-1]))
+    regions_to_remove = [regions[index] for index in np.flatnonzero(selected)]
     remove_white_pixels(images, regions_to_remove, [regions])
 
 
@@ -583,41 +583,43 @@ def get_rel_staff(staff, staff_distance):
     return rel_staff
 
 
-def get_possible_whole_note_regions(regions, bar_lines, clefs, time_signatures, staff_spacing, tolerance=1):
-    bar_line_top = min([r for r, c in bar_lines[0]])
-    bar_line_bot = max([r for r, c in bar_lines[0]])
-    possible_non_whole_note_regions = []
+def get_possible_whole_note_regions(regions, bar_lines, clefs, time_signatures, staff_spacing, tolerance=1,
+                                    features=None):
+    bar_line_top = bar_lines[0].top
+    bar_line_bot = bar_lines[0].bottom
+    if features is None:
+        features = region_features(regions)
+    heights = features['bottom'] - features['top'] + 1
+    selected = (heights < 1.5 * staff_spacing) & \
+        ((features['top'] > bar_line_bot) | (features['bottom'] < bar_line_top))
+    possible_non_whole_note_regions = [regions[index] for index in np.flatnonzero(selected)]
+    possible_non_whole_note_index = irr.RegionIndex(possible_non_whole_note_regions,
+                                                    features[selected])
+    time_signatures_index = irr.RegionIndex(time_signatures)
+    clefs_index = irr.RegionIndex(clefs)
     to_remove = []
-    for region in regions:
-        region_top = min([r for r, c in region])
-        region_bot = max([r for r, c in region])
-        region_height = region_bot - region_top + 1
-        if region_height < 1.5 * staff_spacing and (region_top > bar_line_bot or region_bot < bar_line_top):
-            possible_non_whole_note_regions += [region]
 
     for bar_line in bar_lines:
         closest_region = None
         diff = tolerance * staff_spacing + 1
         closest_time_signature, closest_col, closest_index = \
-            find_closest_region(bar_line, time_signatures)
+            find_closest_region(bar_line, time_signatures, index=time_signatures_index)
         if closest_time_signature is None:
-            closest_clef, closest_col, closest_index = find_closest_region(bar_line, clefs)
+            closest_clef, closest_col, closest_index = find_closest_region(bar_line, clefs, index=clefs_index)
             if closest_clef is None:
-                for region in regions:
-                    region_left = min([c for r, c in region])
-                    region_right = max([c for r, c in region])
-                    bar_line_left = min([c for r, c in bar_line])
-                    if region_left <= bar_line_left <= region_right:
-                        to_remove += [region]
-                        break
+                crossing = np.flatnonzero((features['left'] <= bar_line.left) & (bar_line.left <= features['right']))
+                if len(crossing) > 0:
+                    to_remove += [regions[crossing[0]]]
             else:
                 closest_region, closest_col, closest_index = \
-                    find_closest_region(closest_clef, possible_non_whole_note_regions)
-                diff = closest_col - max([c for r, c in closest_clef])
+                    find_closest_region(closest_clef, possible_non_whole_note_regions,
+                                        index=possible_non_whole_note_index)
+                diff = closest_col - closest_clef.right
         else:
             closest_region, closest_col, closest_index = \
-                find_closest_region(closest_time_signature, possible_non_whole_note_regions)
-            diff = closest_col - max([c for r, c in closest_time_signature])
+                find_closest_region(closest_time_signature, possible_non_whole_note_regions,
+                                    index=possible_non_whole_note_index)
+            diff = closest_col - closest_time_signature.right
         if closest_region is not None and diff < tolerance * staff_spacing:
             to_remove += [closest_region]
 
@@ -629,25 +631,19 @@ def get_possible_whole_note_regions(regions, bar_lines, clefs, time_signatures,
 
 
 def find_whole_notes(image, regions, bar_lines, clefs, time_signatures,
-                     staff, staff_spacing, staff_distance, min_match=0.61):
-    note_templates = {}
-    for templateName in search_for_templates(["note_heads/whole", "note_heads/double_whole"]):
-        template = imp.load_image(templateName)
-        template = imp.resize_image(template, (int(round(staff_spacing)), int(round(staff_spacing))))
-        template = imp.image_gray(template)
-        template = imp.image_bin_otsu(template)
-        template = imp.invert(template)
-        note_templates[templateName] = template
+                     staff, staff_spacing, staff_distance, min_match=0.61, features=None):
+    note_templates = make_template_images(search_for_templates(["note_heads/whole", "note_heads/double_whole"]),
+                                          (int(round(staff_spacing)), int(round(staff_spacing))))
 
     rel_staff = get_rel_staff(staff, staff_distance)
     # find note_heads
     print("Finding whole note heads...")
     notes = []
-    possible_regions = get_possible_whole_note_regions(regions, bar_lines, clefs, time_signatures, staff_spacing)
+    possible_regions = get_possible_whole_note_regions(regions, bar_lines, clefs, time_signatures, staff_spacing,
+                                                       features=features)
     for region in possible_regions:
-        reg_top = min([r for r, c in region])
-        reg_height, reg_width = get_region_image(image, region).shape[:2]
-        if staff_spacing <= reg_width and reg_height >= staff_spacing:
+        reg_top = region.top
+        if staff_spacing <= region.width and region.height >= staff_spacing:
             min_r = rel_staff[0][-1]
             line_index = 0.5
             while abs(min_r - reg_top) >= staff_spacing // 2:
@@ -659,15 +655,14 @@ def find_whole_notes(image, regions, bar_lines, clefs, time_signatures,
                     line_index += 0.5
             min_r = int(min_r)
 
-            max_r = max([r for r, c in region])
+            max_r = region.bottom
             for start_r in range(min_r, max_r, int(staff_spacing // 2)):
-                sub_region = [value for value in region
-                              if start_r + staff_spacing >= value[0] >= start_r]
+                sub_region = region.rows_between(start_r, start_r + staff_spacing)
                 if len(sub_region) > 0:
                     sub_region_img = get_region_image(image, sub_region)
                     best_match = template_match(sub_region_img,
                                                 template_images=note_templates,
-                                                print_results=False)
+                                                print_results=False, min_match=min_match)
                     if min_match <= best_match[1]:
                         notes += [(region, line_index, best_match)]
                 line_index += 0.5
@@ -682,22 +677,24 @@ def find_rests(image, regions, bar_lines, crotchet_min_match=0.68, min_match=0.7
     rests = []
     crotchet_templates = search_for_templates("rests/4")
     all_templates = search_for_templates("rests")
-    bar_line_top = min([r for r, c in bar_lines[0]])
-    bar_line_bot = max([r for r, c in bar_lines[0]])
+    bar_line_top = bar_lines[0].top
+    bar_line_bot = bar_lines[0].bottom
     for region in regions:
-        reg_top = min([r for r, c in region])
-        reg_bot = max([r for r, c in region])
+        reg_top = region.top
+        reg_bot = region.bottom
         if reg_top > bar_line_top and reg_bot < bar_line_bot:
             region_image = get_region_image(image, region)
             best_match = template_match(region_image,
                                         template_filepaths=crotchet_templates,
                                         resize=True,
-                                        print_results=False)
+                                        print_results=False,
+                                        min_match=crotchet_min_match)
             if best_match[1] < crotchet_min_match:
                 best_match = template_match(region_image,
                                             template_filepaths=all_templates,
                                             resize=True,
-                                            print_results=False)
+                                            print_results=False,
+                                            min_match=min_match)
                 if best_match[1] >= min_match:
                     rests += [(region, best_match)]
             else:
@@ -710,33 +707,42 @@ def remove_rests(images, white_pixels, regions):
 
 
 def export_data(index, bar_lines, clefs, time_signatures, endings, notes,
-                accidentals, dots, whole_notes, rests, staff, staff_spacing, staff_distance):
+                accidentals, dots, whole_notes, rests, staff, staff_spacing, staff_distance, print_results=True):
+    """
+    Sorts recognized objects into measures
+    :param print_results: print staff data
+    :return: music_export.Staff
+    """
     rel_staff = get_rel_staff(staff, staff_distance)
-    print("Analysis results of staff %s" % (index + 1))
+    clef_regions = [clef[0] for clef in clefs]
+    time_signature_regions = [time_signature[0] for time_signature in time_signatures]
+    ending_regions = [ending[0] for ending in endings]
+    clefs_index = irr.RegionIndex(clef_regions)
+    time_signatures_index = irr.RegionIndex(time_signature_regions)
+    endings_index = irr.RegionIndex(ending_regions)
+    notes_index = irr.RegionIndex([note[0] for note in notes])
+    whole_notes_index = irr.RegionIndex([note[0] for note in whole_notes])
+    dots_index = irr.RegionIndex([dot[0] for dot in dots])
+    rests_index = irr.RegionIndex([rest[0] for rest in rests])
+    accidentals_index = irr.RegionIndex([accidental[0] for accidental in accidentals])
+    staff_data = me.Staff(index, len(bar_lines))
     for index, bar_line in enumerate(bar_lines):
-        print("Bar Line %s" % (index + 1))
         if index + 1 < len(bar_lines):
-            bar_line_left = min([c for r, c in bar_line])
-            next_bar_line_left = min([c for r, c in bar_lines[index + 1]])
-            closest_region, closest_col, closest_index = find_closest_region(bar_line, [clef[0] for clef in clefs])
+            measure = me.Measure(index)
+            staff_data.measures += [measure]
+            bar_line_left = bar_line.left
+            next_bar_line_left = bar_lines[index + 1].left
+            closest_region, closest_col, closest_index = find_closest_region(bar_line, clef_regions,
+                                                                             index=clefs_index)
             if next_bar_line_left > closest_col > bar_line_left:
                 clef = clefs[closest_index]
                 clef = clef[1]
                 clef = clef[0]
                 clef = clef.split('/')[-1]
-                clef = clef.split('_')[0]
-
-                if clef == "g":
-                    print("G-Clef")
-                elif clef == "f":
-                    print("F-Clef")
-                elif clef == "c":
-                    print("C-Clef")
-                else:
-                    print("Unknown clef!")
+                measure.clef = clef.split('_')[0]
 
             closest_region, closest_col, closest_index = \
-                find_closest_region(bar_line, [time_signature[0] for time_signature in time_signatures])
+                find_closest_region(bar_line, time_signature_regions, index=time_signatures_index)
             if next_bar_line_left > closest_col > bar_line_left:
                 time_signature = time_signatures[closest_index]
                 time_signature = time_signature[1]
@@ -747,23 +753,24 @@ def export_data(index, bar_lines, clefs, time_signatures, endings, notes,
                     bot = time_signature[1][0]
                     bot = bot.split('/')[-1]
                     bot = bot.split('_')[0]
-                    print("Time: %s/%s" % (top, bot))
+                    measure.time = "%s/%s" % (top, bot)
                 else:
                     time_signature = time_signature[0]
                     time_signature = time_signature.split('/')[-1]
-                    time_signature = time_signature.split('_')[0]
-                    print("Time: %s" % time_signature)
+                    measure.time = time_signature.split('_')[0]
 
             closest_region, closest_col, closest_index = \
-                find_closest_region(bar_line, [ending[0] for ending in endings])
+                find_closest_region(bar_line, ending_regions, index=endings_index)
             if next_bar_line_left > closest_col > bar_line_left:
-                print("Ending")
+                measure.ending = True
 
-            sorted_notes = get_sorted_bar_objects(notes, bar_line_left, next_bar_line_left)
-            sorted_whole_notes = get_sorted_bar_objects(whole_notes, bar_line_left, next_bar_line_left)
-            sorted_dots = get_sorted_bar_objects(dots, bar_line_left, next_bar_line_left)
-            sorted_rests = get_sorted_bar_objects(rests, bar_line_left, next_bar_line_left)
-            sorted_accidentals = get_sorted_bar_objects(accidentals, bar_line_left, next_bar_line_left)
+            sorted_notes = get_sorted_bar_objects(notes, bar_line_left, next_bar_line_left, notes_index)
+            sorted_whole_notes = get_sorted_bar_objects(whole_notes, bar_line_left, next_bar_line_left,
+                                                        whole_notes_index)
+            sorted_dots = get_sorted_bar_objects(dots, bar_line_left, next_bar_line_left, dots_index)
+            sorted_rests = get_sorted_bar_objects(rests, bar_line_left, next_bar_line_left, rests_index)
+            sorted_accidentals = get_sorted_bar_objects(accidentals, bar_line_left, next_bar_line_left,
+                                                        accidentals_index)
 
             key_accidentals = []
             for accidental in sorted_accidentals:
@@ -785,14 +792,9 @@ def export_data(index, bar_lines, clefs, time_signatures, endings, notes,
                     if min([distance_to_note, distance_to_whole_note]) > staff_spacing:
                         key_accidentals += [accidental]
 
-            if len(key_accidentals) > 0:
-                print("Key Accidentals:")
-                for accidental in key_accidentals:
-                    sorted_accidentals.remove(accidental)
-                    acc = accidental[1][1][0]
-                    acc = acc.split('/')[-1]
-                    acc = ' '.join(acc.split('_')[:-1])
-                    print("\t %s" % acc)
+            for accidental in key_accidentals:
+                sorted_accidentals.remove(accidental)
+                measure.key += [get_accidental_name(accidental[1][1][0])]
 
             concat_notes = []
             for note in sorted_whole_notes:
@@ -800,18 +802,14 @@ def export_data(index, bar_lines, clefs, time_signatures, endings, notes,
             for note in sorted_notes:
                 concat_notes += [(note[0], note, 1)]
             concat_notes = sorted(concat_notes)
-            if len(concat_notes) > 0:
-                print("Notes:")
             for note in concat_notes:
                 note_type = note[2]
                 if note_type == 0:
-                    print("\twhole note")
-                    print("\t\tcolumn: %s" % note[0])
-                    print("\t\theight: %s" % (note[1][1][1]))
-                    print("\t\tduration: %s" % 1)
+                    event = me.Event(me.Event.WHOLE_NOTE, note[0], 1, note[1][1][1])
+                    measure.notes += [event]
                     min_note_c = note[0]
-                    max_note_c = max([c for r, c in note[1][1][0]])
-                    note_rows = [r for r, c in note[1][1][0]]
+                    max_note_c = note[1][1][0].right
+                    note_rows = note[1][1][0].rows
                     prolonged = False
                     for dot in sorted_dots:
                         if staff_spacing * 1.5 > dot[0] - max_note_c > 0:
@@ -819,62 +817,51 @@ def export_data(index, bar_lines, clefs, time_signatures, endings, notes,
                                 if r in note_rows:
                                     sorted_dots.remove(dot)
                                     prolonged = True
-                                    print("\t\tprolonged duration")
+                                    event.prolonged = True
                                     break
                             if prolonged:
                                 break
                     for accidental in sorted_accidentals:
-                        max_accidental_c = max([c for r, c in accidental[1][0]])
+                        max_accidental_c = accidental[1][0].right
                         if 0 < min_note_c - max_accidental_c < staff_spacing * 2:
                             for r, c in accidental[1][0]:
                                 if r in note_rows:
-                                    acc = accidental[1][1][0]
-                                    acc = acc.split('/')[-1]
-                                    acc = ' '.join(acc.split('_')[:-1])
-                                    print("\t\taccidental: %s" % acc)
+                                    event.accidentals += [get_accidental_name(accidental[1][1][0])]
                                     sorted_accidentals.remove(accidental)
 
                 else:
                     subnotes = note[1][1][2]
                     region = note[1][1][0]
-                    region_min_r = min([r for r, c in region])
-                    region_max_r = max([r for r, c in region])
+                    region_min_r = region.top
+                    region_max_r = region.bottom
                     for subnote in subnotes:
-                        print("\tstem note")
                         note_col = note[0] + subnote[0]
-                        print("\t\tcolumn: %s" % note_col)
-                        print("\t\theight: %s" % subnote[1])
-                        print("\t\tduration: %s" % subnote[3])
+                        event = me.Event(me.Event.STEM_NOTE, note_col, subnote[3], subnote[1])
+                        measure.notes += [event]
                         for dot in sorted_dots:
-                            dot_min_r = min([r for r, c in dot[1][0]])
+                            dot_min_r = dot[1][0].top
                             if staff_spacing * 2.5 > dot[0] - note_col > 0 \
                                     and region_min_r < dot_min_r < region_max_r:
                                 dot_height = dot_min_r - rel_staff[0][0]
                                 dot_height /= staff_spacing
                                 if abs(dot_height - subnote[1]) < 1:
                                     sorted_dots.remove(dot)
-                                    print("\t\tprolonged duration")
+                                    event.prolonged = True
                                     break
 
                         for accidental in sorted_accidentals:
-                            max_accidental_c = max([c for r, c in accidental[1][0]])
-                            min_accidental_r = min([r for r, c in accidental[1][0]])
+                            max_accidental_c = accidental[1][0].right
+                            min_accidental_r = accidental[1][0].top
                             center_accidental_r =\
-                                (max([r for r, c in accidental[1][0]]) - min_accidental_r) / 2 + min_accidental_r
+                                (accidental[1][0].bottom - min_accidental_r) / 2 + min_accidental_r
                             if 0 < note_col - max_accidental_c < staff_spacing * 2 and \
                                     region_min_r < center_accidental_r < region_max_r:
                                 acc_height = center_accidental_r - rel_staff[0][0]
                                 acc_height /= staff_spacing
                                 if abs(acc_height - subnote[1]) <= 0.5:
-                                    acc = accidental[1][1][0]
-                                    acc = acc.split('/')[-1]
-                                    acc = ' '.join(acc.split('_')[:-1])
-                                    print("\t\taccidental: %s" % acc)
+                                    event.accidentals += [get_accidental_name(accidental[1][1][0])]
                                     sorted_accidentals.remove(accidental)
-            if len(sorted_rests) > 0:
-                print("Rests:")
             for rest in sorted_rests:
-                print("\trest")
                 rest_type = rest[1][1][0]
                 rest_type = rest_type.split('/')[-1]
                 rest_type = rest_type.split('_')[0]
@@ -882,15 +869,15 @@ def export_data(index, bar_lines, clefs, time_signatures, endings, notes,
                 rest_type = 1. / rest_type
                 if rest_type == 0.5:
                     rest_reg = rest[1][0]
-                    min_rest_r = min([r for r, c in rest_reg])
+                    min_rest_r = rest_reg.top
                     if min_rest_r in rel_staff[1]:
                         rest_type = 1
-                print("\t\tcolumn: %s" % rest[0])
-                print("\t\tduration: %s" % rest_type)
+                event = me.Event(me.Event.REST, rest[0], rest_type)
+                measure.rests += [event]
                 for dot in sorted_dots:
                     if staff_spacing * 2 > dot[0] - rest[0] > 0:
                         sorted_dots.remove(dot)
-                        print("\t\tprolonged duration")
+                        event.prolonged = True
                         break
             repeat_begin = []
             repeat_end = []
@@ -900,20 +887,31 @@ def export_data(index, bar_lines, clefs, time_signatures, endings, notes,
                 elif next_bar_line_left - dot[0] < 2 * staff_spacing:
                     repeat_end += [dot]
 
-            if len(repeat_begin) == 2:
-                print("Repeat Begin")
-            if len(repeat_end) == 2:
-                print("Repeat End")
+            measure.repeat_begin = len(repeat_begin) == 2
+            measure.repeat_end = len(repeat_end) == 2
+
+    if print_results:
+        staff_data.print_data()
+    return staff_data
+
 
-                # repeat dots
+def get_accidental_name(template_filepath):
+    """
+    :param template_filepath: path of matched accidental template, e.g. templates/accidentals/double_flat_01.jpg
+    :return: name of accidental, e.g. double flat
+    """
+    return ' '.join(template_filepath.split('/')[-1].split('_')[:-1])
 
 
-def get_sorted_bar_objects(objects, min_c, max_c):
+def get_sorted_bar_objects(objects, min_c, max_c, index=None):
+    if index is not None:
+        objects = [objects[obj_index] for obj_index in index.overlapping(min_c + 1, max_c - 1)]
     sorted_objects = []
     for obj in objects:
-        bar_obj_cols = [c for r, c in obj[0] if max_c > c > min_c]
+        obj_cols = irr.as_region(obj[0]).cols
+        bar_obj_cols = obj_cols[(max_c > obj_cols) & (obj_cols > min_c)]
         if len(bar_obj_cols) > 0:
-            obj_left = min(bar_obj_cols)
+            obj_left = int(bar_obj_cols.min())
             sorted_objects += [(obj_left, obj)]
     sorted_objects = sorted(sorted_objects)
     return sorted_objects
@@ -0,0 +1,405 @@
+import json
+import numpy as np
+from xml.sax.saxutils import escape
+
+
+CLEF_NAMES = {'g': "G-Clef", 'f': "F-Clef", 'c': "C-Clef"}
+
+# pitch of the top staff line for each clef, as (step, octave)
+CLEF_TOP_LINES = {'g': ('F', 5), 'f': ('A', 3), 'c': ('G', 4)}
+
+STEPS = 'CDEFGAB'
+SHARPS_ORDER = 'FCGDAEB'
+FLATS_ORDER = 'BEADGCF'
+
+ACCIDENTAL_ALTERS = {'sharp': 1, 'flat': -1, 'natural': 0, 'double sharp': 2, 'double flat': -2}
+
+# MusicXML accidental values of recognized accidentals
+MUSICXML_ACCIDENTALS = {'sharp': 'sharp', 'flat': 'flat', 'natural': 'natural',
+                        'double sharp': 'double-sharp', 'double flat': 'flat-flat'}
+
+NOTE_TYPES = {1: 'whole', 0.5: 'half', 0.25: 'quarter', 0.125: 'eighth', 1 / 16.: '16th',
+              1 / 32.: '32nd', 1 / 64.: '64th', 1 / 128.: '128th'}
+
+
+def plain(value):
+    """Converts numpy scalars to python values, so they can be serialized
+    :param value:
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class Event(object):
+    """Note or rest of a measure"""
+    WHOLE_NOTE = "whole note"
+    STEM_NOTE = "stem note"
+    REST = "rest"
+
+    def __init__(self, kind, column, duration, height=None):
+        """
+        :param kind: WHOLE_NOTE, STEM_NOTE or REST
+        :param column: column of the event in staff image
+        :param duration: duration in whole notes, without prolongation
+        :param height: position on staff in staff spacings below top line, None for rests
+        """
+        self.kind = kind
+        self.column = column
+        self.duration = duration
+        self.height = height
+        self.prolonged = False
+        self.accidentals = []
+
+    @property
+    def is_rest(self):
+        return self.kind == Event.REST
+
+    def to_dict(self):
+        return {'type': self.kind, 'column': plain(self.column), 'height': plain(self.height),
+                'duration': plain(self.duration), 'prolonged': self.prolonged,
+                'accidentals': list(self.accidentals)}
+
+    def print_data(self):
+        print("\t%s" % self.kind)
+        print("\t\tcolumn: %s" % self.column)
+        if not self.is_rest:
+            print("\t\theight: %s" % self.height)
+        print("\t\tduration: %s" % self.duration)
+        if self.prolonged:
+            print("\t\tprolonged duration")
+        for accidental in self.accidentals:
+            print("\t\taccidental: %s" % accidental)
+
+
+class Measure(object):
+    """Contents of staff between two bar lines"""
+
+    def __init__(self, index):
+        self.index = index
+        self.clef = None
+        self.time = None
+        self.ending = False
+        self.key = []
+        self.notes = []
+        self.rests = []
+        self.repeat_begin = False
+        self.repeat_end = False
+
+    @property
+    def events(self):
+        """Notes and rests, sorted by column"""
+        return sorted(self.notes + self.rests, key=lambda event: event.column)
+
+    def to_dict(self):
+        return {'index': self.index, 'clef': self.clef, 'time': self.time, 'ending': self.ending,
+                'key': list(self.key), 'repeat_begin': self.repeat_begin, 'repeat_end': self.repeat_end,
+                'events': [event.to_dict() for event in self.events]}
+
+    def print_data(self):
+        if self.clef is not None:
+            print(CLEF_NAMES.get(self.clef, "Unknown clef!"))
+        if self.time is not None:
+            print("Time: %s" % self.time)
+        if self.ending:
+            print("Ending")
+        if len(self.key) > 0:
+            print("Key Accidentals:")
+            for accidental in self.key:
+                print("\t %s" % accidental)
+        if len(self.notes) > 0:
+            print("Notes:")
+        for note in self.notes:
+            note.print_data()
+        if len(self.rests) > 0:
+            print("Rests:")
+        for rest in self.rests:
+            rest.print_data()
+        if self.repeat_begin:
+            print("Repeat Begin")
+        if self.repeat_end:
+            print("Repeat End")
+
+
+class Staff(object):
+    """Measures of one staff. Every bar line but the last one starts a measure."""
+
+    def __init__(self, index, bar_lines=0):
+        self.index = index
+        self.bar_lines = bar_lines
+        self.measures = []
+
+    def to_dict(self):
+        return {'index': self.index, 'bar_lines': self.bar_lines,
+                'measures': [measure.to_dict() for measure in self.measures]}
+
+    def print_data(self):
+        print("Analysis results of staff %s" % (self.index + 1))
+        for index in range(self.bar_lines):
+            print("Bar Line %s" % (index + 1))
+            if index < len(self.measures):
+                self.measures[index].print_data()
+
+
+class Page(object):
+    """Staves recognized on one image"""
+
+    def __init__(self, name):
+        self.name = name
+        self.staves = []
+
+    def to_dict(self):
+        return {'page': self.name, 'staves': [staff.to_dict() for staff in self.staves]}
+
+
+def note_step(height, clef='g'):
+    """
+    Diatonic step of a note, counted from C0
+    :param height: position on staff in staff spacings below top line
+    :param clef: 'g', 'f' or 'c', unknown clefs are read as 'g'
+    :return: step number, 7 steps per octave
+    """
+    step, octave = CLEF_TOP_LINES.get(clef, CLEF_TOP_LINES['g'])
+    return octave * 7 + STEPS.index(step) - int(round(height * 2))
+
+
+def note_pitch(height, clef='g'):
+    """
+    Pitch of a note, without alteration
+    :param height: position on staff in staff spacings below top line
+    :param clef: 'g', 'f' or 'c'
+    :return: (step, octave), e.g. ('F', 5) for top line of G clef
+    """
+    step = note_step(height, clef)
+    return STEPS[step % 7], step // 7
+
+
+def key_alterations(key):
+    """
+    Alteration of each step in a key
+    :param key: names of key accidentals, e.g. ['sharp', 'sharp']
+    :return: dict from step name to alteration
+    """
+    sharps = len([accidental for accidental in key if accidental == 'sharp'])
+    flats = len([accidental for accidental in key if accidental == 'flat'])
+    if sharps >= flats:
+        return dict((step, 1) for step in SHARPS_ORDER[:sharps])
+    return dict((step, -1) for step in FLATS_ORDER[:flats])
+
+
+def key_fifths(key):
+    """
+    Position of a key in circle of fifths
+    :param key: names of key accidentals
+    :return: number of sharps, or negative number of flats
+    """
+    alterations = key_alterations(key)
+    return sum(alterations.values())
+
+
+def parse_time(time):
+    """
+    :param time: time signature as exported, e.g. '3/4', 'common' or 'cut'
+    :return: (beats, beat type, symbol), None when time can not be read
+    """
+    if time == 'common':
+        return 4, 4, 'common'
+    if time == 'cut':
+        return 2, 2, 'cut'
+    parts = str(time).split('/')
+    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+        return int(parts[0]), int(parts[1]), None
+    return None
+
+
+class PitchTracker(object):
+    """Follows clef, key and measure accidentals, to find alteration of each note"""
+
+    def __init__(self):
+        self.clef = 'g'
+        self.key = []
+        self.key_alterations = {}
+        self.measure_alterations = {}
+
+    def start_measure(self, measure):
+        if measure.clef is not None:
+            self.clef = measure.clef
+        if len(measure.key) > 0:
+            self.key = list(measure.key)
+            self.key_alterations = key_alterations(self.key)
+        self.measure_alterations = {}
+
+    def pitch(self, event):
+        """
+        :param event: note event
+        :return: (step, octave, alteration)
+        """
+        step, octave = note_pitch(event.height, self.clef)
+        alteration = None
+        for accidental in event.accidentals:
+            if accidental in ACCIDENTAL_ALTERS:
+                alteration = ACCIDENTAL_ALTERS[accidental]
+        if alteration is not None:
+            self.measure_alterations[(step, octave)] = alteration
+        else:
+            alteration = self.measure_alterations.get((step, octave),
+                                                      self.key_alterations.get(step, 0))
+        return step, octave, alteration
+
+
+class ResultWriter(object):
+    """Base of writers that stream recognition results to a file, staff by staff.
+    Output is either a path or an open file object, which is then left open.
+    """
+
+    def __init__(self, output):
+        if isinstance(output, str):
+            self.file = open(output, 'w')
+            self.owns_file = True
+        else:
+            self.file = output
+            self.owns_file = False
+        self.page = None
+
+    def begin_page(self, page):
+        self.page = page
+
+    def write_staff(self, staff):
+        raise NotImplementedError
+
+    def end_page(self):
+        self.page = None
+
+    def close(self):
+        if self.owns_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class JsonLinesWriter(ResultWriter):
+    """Writes one JSON object per staff"""
+
+    def write_staff(self, staff):
+        record = staff.to_dict()
+        record['page'] = self.page.name if self.page is not None else None
+        self.file.write(json.dumps(record, default=plain) + "\n")
+
+
+class MusicXmlWriter(ResultWriter):
+    """Writes staves as measures of a single part of a partwise MusicXML score.
+    Each staff starts a new system and each page a new page.
+    """
+
+    def __init__(self, output, title="", divisions=64):
+        """
+        :param output: path or file object
+        :param title: title of the work
+        :param divisions: divisions of a quarter note
+        """
+        ResultWriter.__init__(self, output)
+        self.divisions = divisions
+        self.measure_number = 0
+        self.new_page = False
+        self.pitches = PitchTracker()
+        self.file.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+                        '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.1 Partwise//EN" '
+                        '"http://www.musicxml.org/dtds/partwise.dtd">\n'
+                        '<score-partwise version="3.1">\n')
+        if title:
+            self.file.write('  <work><work-title>%s</work-title></work>\n' % escape(title))
+        self.file.write('  <part-list>\n'
+                        '    <score-part id="P1"><part-name>Music</part-name></score-part>\n'
+                        '  </part-list>\n'
+                        '  <part id="P1">\n')
+
+    def begin_page(self, page):
+        ResultWriter.begin_page(self, page)
+        self.new_page = self.measure_number > 0
+
+    def write_staff(self, staff):
+        for index, measure in enumerate(staff.measures):
+            self.write_measure(measure, new_system=index == 0)
+
+    def write_measure(self, measure, new_system=False):
+        self.measure_number += 1
+        lines = ['    <measure number="%s">' % self.measure_number]
+        if new_system and self.measure_number > 1:
+            lines += ['      <print new-%s="yes"/>' % ("page" if self.new_page else "system")]
+            self.new_page = False
+        if measure.repeat_begin:
+            lines += ['      <barline location="left"><repeat direction="forward"/></barline>']
+
+        self.pitches.start_measure(measure)
+        lines += self.attributes(measure)
+        previous = None
+        for event in measure.events:
+            chord = previous is not None and event.kind == Event.STEM_NOTE and \
+                previous.kind == Event.STEM_NOTE and previous.column == event.column
+            lines += self.note(event, chord)
+            previous = event
+
+        if measure.repeat_end:
+            lines += ['      <barline location="right"><repeat direction="backward"/></barline>']
+        lines += ['    </measure>']
+        self.file.write("\n".join(lines) + "\n")
+
+    def attributes(self, measure):
+        first = self.measure_number == 1
+        lines = []
+        if first:
+            lines += ['        <divisions>%s</divisions>' % self.divisions]
+        if first or len(measure.key) > 0:
+            lines += ['        <key><fifths>%s</fifths></key>' % key_fifths(self.pitches.key)]
+        time = parse_time(measure.time) if measure.time is not None else None
+        if time is not None:
+            beats, beat_type, symbol = time
+            symbol = ' symbol="%s"' % symbol if symbol is not None else ''
+            lines += ['        <time%s><beats>%s</beats><beat-type>%s</beat-type></time>'
+                      % (symbol, beats, beat_type)]
+        if first or measure.clef is not None:
+            sign, line = {'g': ('G', 2), 'f': ('F', 4), 'c': ('C', 3)}.get(self.pitches.clef, ('G', 2))
+            lines += ['        <clef><sign>%s</sign><line>%s</line></clef>' % (sign, line)]
+        if len(lines) == 0:
+            return []
+        return ['      <attributes>'] + lines + ['      </attributes>']
+
+    def note(self, event, chord=False):
+        duration = float(event.duration)
+        divisions = max(1, int(round(duration * 4 * self.divisions * (1.5 if event.prolonged else 1))))
+        lines = ['      <note>']
+        if chord:
+            lines += ['        <chord/>']
+        if event.is_rest:
+            lines += ['        <rest/>']
+        else:
+            step, octave, alteration = self.pitches.pitch(event)
+            alter = '<alter>%s</alter>' % alteration if alteration != 0 else ''
+            lines += ['        <pitch><step>%s</step>%s<octave>%s</octave></pitch>' % (step, alter, octave)]
+        lines += ['        <duration>%s</duration>' % divisions]
+        if duration in NOTE_TYPES:
+            lines += ['        <type>%s</type>' % NOTE_TYPES[duration]]
+        if event.prolonged:
+            lines += ['        <dot/>']
+        for accidental in event.accidentals:
+            if accidental in MUSICXML_ACCIDENTALS:
+                lines += ['        <accidental>%s</accidental>' % MUSICXML_ACCIDENTALS[accidental]]
+        lines += ['      </note>']
+        return lines
+
+    def close(self):
+        if self.measure_number == 0:
+            # a part needs at least one measure
+            self.file.write('    <measure number="1"/>\n')
+        self.file.write('  </part>\n'
+                        '</score-partwise>\n')
+        ResultWriter.close(self)
+
+
+WRITERS = {'jsonl': JsonLinesWriter, 'musicxml': MusicXmlWriter}
@@ -0,0 +1,133 @@
+"""
+Binary images packed to bits, eight pixels per byte.
+
+Images of the pipeline are binary, 0 for black and 255 for white pixels,
+so a row of them fits in an eighth of the bytes as bits of white pixels
+(np.packbits). Packed images are compared with XOR, and differing pixels
+are counted with a popcount table. For comparisons at any column offset,
+a packed image keeps copies of itself shifted left by 0 to 7 columns,
+so a window starting at any column is a run of whole bytes of one copy.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# number of set bits of every byte value
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+class PackedImage(object):
+    """Binary image with rows packed to bits, set bits are white pixels"""
+    __slots__ = ('bits', 'height', 'width', '_shifts')
+
+    def __init__(self, bits, width):
+        """
+        :param bits: uint8 array of packed rows, see pack_image
+        :param width: number of columns of the image
+        """
+        self.bits = bits
+        self.height = bits.shape[0]
+        self.width = width
+        self._shifts = None
+
+    @classmethod
+    def from_image(cls, image):
+        """
+        :param image: binary image
+        """
+        return cls(pack_image(image), image.shape[1])
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def size(self):
+        return self.height * self.width
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def count_white(self):
+        """Number of white pixels"""
+        if self.bits.size == 0:
+            return 0
+        return int(POPCOUNT[self.bits[:, :-1]].sum(dtype=np.int64)
+                   + POPCOUNT[self.bits[:, -1] & last_byte_mask(self.width)].sum(dtype=np.int64))
+
+    def unpack(self):
+        """Binary uint8 image, 0 or 255"""
+        return unpack_image(self.bits, self.width)
+
+    def shifted(self, shift):
+        """Packed rows of the image without its first shift columns,
+        for shift from 0 to 7. Shifted rows are made once, when first needed.
+        :param shift:
+        """
+        if self._shifts is None:
+            white = np.unpackbits(self.bits, axis=1, count=self.width)
+            self._shifts = [np.packbits(white[:, s:], axis=1) for s in range(min(8, self.width))]
+        return self._shifts[shift]
+
+    def __repr__(self):
+        return "PackedImage(height=%s, width=%s)" % (self.height, self.width)
+
+
+def is_binary(image):
+    """Whether image has only 0 and 255 pixels
+    :param image:
+    """
+    return not np.any((image != 0) & (image != 255))
+
+
+def pack_image(image):
+    """Pack rows of binary image to bits, 255 pixels are set bits
+    :param image:
+    """
+    return np.packbits(image == 255, axis=1)
+
+
+def unpack_image(bits, width):
+    """Inverse of pack_image
+    :param bits:
+    :param width: number of columns of the image
+    """
+    return np.unpackbits(bits, axis=1, count=width) * np.uint8(255)
+
+
+def last_byte_mask(width):
+    """Mask of bits of the last byte of a packed row that are pixels
+    :param width:
+    """
+    return np.uint8((0xFF << (8 * ((width + 7) // 8) - width)) & 0xFF)
+
+
+def mismatch_map(obj, template):
+    """Return a map with the number of differing pixels for every position
+    of the template inside obj, counted as popcount(obj XOR template) over
+    packed rows. Positions are computed for one shift of obj at a time,
+    every eighth column of the map.
+    :param obj: PackedImage
+    :param template: PackedImage
+    """
+    map_height = max(obj.height - template.height + 1, 0)
+    map_width = max(obj.width - template.width + 1, 0)
+    mismatches = np.zeros((map_height, map_width), dtype=np.int64)
+    if map_height == 0 or map_width == 0:
+        return mismatches
+
+    template_bytes = template.bits.shape[1]
+    mask = last_byte_mask(template.width)
+    if map_height == 1 and map_width == 1:
+        differences = obj.bits[:, :template_bytes] ^ template.bits
+        differences[:, -1] &= mask
+        mismatches[0, 0] = POPCOUNT[differences].sum(dtype=np.int64)
+        return mismatches
+    for shift in range(min(8, map_width)):
+        positions = len(range(shift, map_width, 8))
+        windows = sliding_window_view(obj.shifted(shift), (template.height, template_bytes))
+        differences = windows[:, :positions] ^ template.bits
+        differences[..., -1] &= mask
+        mismatches[:, shift::8] = POPCOUNT[differences].sum(axis=(2, 3), dtype=np.int64)
+    return mismatches
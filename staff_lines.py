@@ -1,5 +1,6 @@
 import numpy as np
 import image_operations as imo
+import instrumentation as ins
 
 
 def find_lines(image, projection=True, horizontal_opening=True):
@@ -10,20 +11,16 @@ def find_lines(image, projection=True, horizontal_opening=True):
     :param projection:
     :param horizontal_opening:
     """
+    ins.count(ins.PIXELS_SCANNED, image.size)
 
     first = None
     second = None
     if projection:
-        first = get_white_rows(imo.crop_image(
-            imo.project_image(image)))
+        first = get_projection_rows(image)
     if horizontal_opening:
         if projection:
-            line_distances = group_rows(first)[1]
-            avg_staff_spacing = []
-            for staff_line_distances in line_distances:
-                avg_staff_spacing += staff_line_distances
-            avg_staff_spacing = sum(avg_staff_spacing) * 1. / len(avg_staff_spacing)
-            second = get_white_rows(imo.open_image(image, np.ones((1, 2 * avg_staff_spacing))))
+            avg_staff_spacing = average_spacing(group_rows(first)[1])
+            second = get_white_rows(imo.open_image(image, np.ones((1, int(2 * avg_staff_spacing)))))
         else:
             second = get_white_rows(imo.open_image(image, np.ones((1, 20))))
 
@@ -37,13 +34,17 @@ def find_lines(image, projection=True, horizontal_opening=True):
         raise Exception("To find lines either horizontal projection"
                         "of the image must be done or a horizontal"
                         "morphological opening")
+    return lines_from_rows(image_lines)
 
+
+def lines_from_rows(image_lines):
+    """Group rows of staff lines by staves and lines and return them
+    with distances between them, as find_lines does
+    :param image_lines: row numbers of staff line pixels
+    """
     lines, line_distances, staff_distances = \
         group_rows(image_lines)
-    avg_staff_spacing = []
-    for staff_line_distances in line_distances:
-        avg_staff_spacing += staff_line_distances
-    avg_staff_spacing = sum(avg_staff_spacing) * 1. / len(avg_staff_spacing)
+    avg_staff_spacing = average_spacing(line_distances)
     if len(staff_distances) > 0:
         avg_staff_distance = sum(staff_distances) * 1. / len(staff_distances)
     else:
@@ -51,17 +52,43 @@ def find_lines(image, projection=True, horizontal_opening=True):
     return lines, line_distances, avg_staff_spacing, staff_distances, avg_staff_distance
 
 
+def average_spacing(line_distances):
+    """Average distance between lines of all staves
+    :param line_distances: distances between lines of each staff
+    """
+    avg_staff_spacing = []
+    for staff_line_distances in line_distances:
+        avg_staff_spacing += staff_line_distances
+    return sum(avg_staff_spacing) * 1. / len(avg_staff_spacing)
+
+
+def get_projection_rows(image):
+    """Find row numbers of rows whose number of white pixels is
+    in the top third of the largest one. Same as
+    get_white_rows(imo.crop_image(imo.project_image(image))),
+    computed from the row sums only.
+    :param image:
+    """
+    return projection_rows(np.count_nonzero(np.asarray(image) == 255, axis=1))
+
+
+def projection_rows(row_sums):
+    """get_projection_rows from number of white pixels of each row
+    :param row_sums:
+    """
+    row_sums = np.asarray(row_sums)
+    end = int(row_sums.max()) if len(row_sums) > 0 else 0
+    crop_width = end // 3
+    if crop_width == 0:
+        return []
+    return np.flatnonzero(row_sums > end - crop_width).tolist()
+
+
 def get_white_rows(image):
     """Find row numbers of white pixels in an image
     :param image:
     """
-    rows = []
-    height, width = image.shape[:2]
-    for row in range(height):
-        for col in range(width):
-            if (image[row][col] == 255) and (row not in rows):
-                rows.append(row)
-    return sorted(rows)
+    return np.flatnonzero((np.asarray(image) == 255).any(axis=1)).tolist()
 
 
 def intersect_lists(first, second):
@@ -69,11 +96,8 @@ def intersect_lists(first, second):
     :param first:
     :param second:
     """
-    ret_val = []
-    for val in first:
-        if val in second:
-            ret_val += [val]
-    return ret_val
+    second = set(second)
+    return [val for val in first if val in second]
 
 
 def group_rows(rows, tolerance=3, max_failed_checks=3):
@@ -134,7 +158,8 @@ def remove_lines(org_image,
                  top_bot_pixel_removal=True,
                  top_bot_pixel_diff=2,
                  thickness_based_removal=True,
-                 thickness_tolerance=0):
+                 thickness_tolerance=0,
+                 avg_thickness=None):
     """Return an image that represents a copy of the original without the
     staff lines
     :param org_image:
@@ -142,63 +167,58 @@ def remove_lines(org_image,
     :param top_bot_pixel_removal:
     :param top_bot_pixel_diff:
     :param thickness_based_removal:
-    :param thickness_tolerance: """
+    :param thickness_tolerance:
+    :param avg_thickness: average thickness of staff lines, computed from lines when not given,
+    e.g. lines of the whole page when only some staves are removed """
 
+    ins.count(ins.PIXELS_SCANNED, org_image.size)
     image = org_image.copy()
 
     if lines is None:
         lines = find_lines(org_image)[0]
 
-    image_height, image_width = image.shape[:2]
     if top_bot_pixel_removal:
         for staff in lines:
             for line in staff:
                 top = line[0]
                 bot = line[-1]
-                for j in range(image_width):
-                    remove = True
-                    is_line = False
-                    for row in image[top:bot + 1]:
-                        if row[j] == 255:
-                            is_line = True
-                            break
-                    if not is_line:
-                        continue
-                    # check top_bot_pixel_diff pixels above and below
-                    for row in image[top - top_bot_pixel_diff: top]:
-                        if row[j] == 255:
-                            remove = False
-                            break
-                    if remove:
-                        for row in image[bot + 1: bot + top_bot_pixel_diff + 1]:
-                            if row[j] == 255:
-                                remove = False
-                                break
-                        if remove:
-                            for row in image[top:bot + 1]:
-                                row[j] = 0
+                is_line = (image[top:bot + 1] == 255).any(axis=0)
+                # check top_bot_pixel_diff pixels above and below
+                above = (image[top - top_bot_pixel_diff: top] == 255).any(axis=0)
+                below = (image[bot + 1: bot + top_bot_pixel_diff + 1] == 255).any(axis=0)
+                image[top:bot + 1, is_line & ~above & ~below] = 0
 
     if thickness_based_removal:
 
-        avg_thickness = []
+        if avg_thickness is None:
+            avg_thickness = average_thickness(lines)
+
         for staff in lines:
-            for line in staff:
-                avg_thickness += [len(line)]
-        avg_thickness = sum(avg_thickness) * 1. / len(avg_thickness)
-
-        for j in range(image_width):
-            for staff in lines:
-                checking_line = False
-                for i in range(staff[0][0], staff[-1][-1]+2):
-                    if image[i][j] == 255:
-                        if not checking_line:
-                            start = i
-                        checking_line = True
-                    else:
-                        if checking_line:
-                            thickness = i - start
-                            if thickness <= (avg_thickness + thickness_tolerance):
-                                for row in image[start: i]:
-                                    row[j] = 0
-                        checking_line = False
+            staff_band = image[staff[0][0]:staff[-1][-1] + 2]
+            staff_band[thin_vertical_runs(staff_band, avg_thickness + thickness_tolerance)] = 0
     return image
+
+
+def average_thickness(lines):
+    """Average number of rows of staff lines
+    :param lines:
+    """
+    avg_thickness = []
+    for staff in lines:
+        for line in staff:
+            avg_thickness += [len(line)]
+    return sum(avg_thickness) * 1. / len(avg_thickness)
+
+
+def thin_vertical_runs(image, max_thickness):
+    """Return mask of white pixels in vertical runs of at most
+    max_thickness pixels, that end with a black pixel inside the image.
+    :param image:
+    :param max_thickness:
+    """
+    white = image == 255
+    height = white.shape[0]
+    rows = np.arange(height)[:, np.newaxis]
+    run_starts = np.maximum.accumulate(np.where(white, -1, rows), axis=0) + 1
+    run_ends = np.minimum.accumulate(np.where(white, height, rows)[::-1], axis=0)[::-1]
+    return white & (run_ends < height) & (run_ends - run_starts <= max_thickness)
@@ -0,0 +1,196 @@
+"""
+Content-addressed on-disk cache of intermediate pipeline stages.
+
+An entry is keyed by its inputs (image hashes or keys of upstream entries),
+stage name, stage parameters and a hash of the source code of the modules
+the stage runs, and is stored as a compressed .npz file. When the cache grows
+over its size limit, least recently used entries are removed. Label maps
+are cached only for images of at least MIN_CACHED_PIXELS pixels.
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import instrumentation as ins
+
+
+# modules whose source code decides the result of each stage
+STAGE_MODULES = {
+    'binarize': ('image_processing',),
+    'find_lines': ('staff_lines', 'image_operations'),
+    'remove_lines': ('staff_lines', 'image_operations'),
+    'label_regions': ('image_region_recognition',),
+}
+
+JSON_KEY = '__json__'
+
+# label maps of smaller images, e.g. crops of single symbols, are computed
+# faster than they are hashed and loaded, so they are not cached
+MIN_CACHED_PIXELS = 1 << 19
+
+_active = None
+
+
+def array_hash(array):
+    """Hash of array content, shape and type
+    :param array:
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1()
+    digest.update(("%s%s" % (array.dtype.str, array.shape)).encode())
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+def code_version(module_names):
+    """Hash of source code of modules
+    :param module_names:
+    """
+    digest = hashlib.sha1()
+    for name in module_names:
+        module = sys.modules.get(name)
+        if module is None:
+            module = __import__(name)
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def active():
+    """Cache used by pipeline stages, None when caching is off"""
+    return _active
+
+
+def activate(cache):
+    """Use cache in pipeline stages
+    :param cache: StageCache or None to turn caching off
+    :return: previously active cache
+    """
+    global _active
+    previous = _active
+    _active = cache
+    return previous
+
+
+class StageCache(object):
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        """
+        :param directory: directory entries are stored in, created if missing
+        :param max_bytes: size limit of all entries
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._code_versions = {}
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self._entries())
+
+    def _entries(self):
+        for root, folders, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.npz'):
+                    yield os.path.join(root, name)
+
+    def code_version(self, stage):
+        if stage not in self._code_versions:
+            self._code_versions[stage] = code_version(STAGE_MODULES.get(stage, ()))
+        return self._code_versions[stage]
+
+    def key(self, stage, inputs, params=None):
+        """
+        :param stage: stage name
+        :param inputs: arrays, or keys and hashes of upstream stages
+        :param params: JSON serializable stage parameters
+        :return: key of the entry
+        """
+        input_hashes = [value if isinstance(value, str) else array_hash(value) for value in inputs]
+        description = json.dumps([stage, input_hashes, params or {}, self.code_version(stage)],
+                                 sort_keys=True)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def load(self, key):
+        """
+        :param key:
+        :return: dict of stored arrays, with stored value under JSON_KEY, None on a miss
+        """
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                entry = dict((name, data[name]) for name in data.files)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            ins.count(ins.CACHE_MISSES)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # removed by another process since it was loaded
+            pass
+        if JSON_KEY in entry:
+            entry[JSON_KEY] = json.loads(str(entry[JSON_KEY]))
+        self.hits += 1
+        ins.count(ins.CACHE_HITS)
+        return entry
+
+    def store(self, key, value=None, **arrays):
+        """
+        :param key:
+        :param value: JSON serializable value, stored with arrays
+        :param arrays: arrays to store
+        """
+        if value is not None:
+            arrays[JSON_KEY] = np.array(json.dumps(value, default=_plain))
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+        descriptor, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.size += os.path.getsize(path) - previous_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until cache fits its size limit"""
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        for path in list(self._entries()):
+            os.remove(path)
+        self.size = 0
+
+
+def _plain(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Can not store %r" % (value,))
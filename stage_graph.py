@@ -0,0 +1,167 @@
+"""
+Dependency graph of named pipeline stages with incremental recomputation.
+
+A stage is a pure function of named inputs and keyword parameters, and
+produces named outputs. Values are versioned: every time a stage runs its
+outputs get new versions. On run(), a stage is computed again only when its
+parameters or the version of one of its inputs changed since its last run,
+otherwise results it produced before are reused from memory.
+
+    graph = StageGraph([Stage('opened', open_image, ('image',), ('opened',)),
+                        Stage('regions', find_regions, ('opened',), ('regions',), {'pixel_span': 2})])
+    graph.set_input('image', image)
+    graph.run()
+    graph.set_params('regions', pixel_span=3)
+    graph.run()  # only 'regions' is computed again
+"""
+import instrumentation as ins
+
+
+class Stage(object):
+
+    def __init__(self, name, function, inputs=(), outputs=(), params=None):
+        """
+        :param name: stage name, unique in graph
+        :param function: called with input values as positional arguments and
+        parameters as keyword arguments, returns a tuple of output values, or
+        a single value when stage has one output. It must not modify its arguments.
+        :param inputs: names of values the stage reads
+        :param outputs: names of values the stage produces
+        :param params: default keyword parameters of function
+        """
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.params = dict(params or {})
+
+    def __repr__(self):
+        return "Stage(%r, %s -> %s)" % (self.name, ", ".join(self.inputs), ", ".join(self.outputs))
+
+
+class StageGraph(object):
+
+    def __init__(self, stages):
+        """
+        :param stages: Stage objects, every input has to be either produced
+        by one of preceding stages or set with set_input
+        """
+        self.stages = []
+        self.producers = {}
+        self.values = {}
+        self.versions = {}
+        self.recomputed = []
+        self._version = 0
+        self._signatures = {}
+        for stage in stages:
+            self.add_stage(stage)
+
+    def add_stage(self, stage):
+        if stage.name in [other.name for other in self.stages]:
+            raise Exception("Stage already exists: %s" % stage.name)
+        for name in stage.outputs:
+            if name in self.producers:
+                raise Exception("Value %s is produced by stages %s and %s"
+                                % (name, self.producers[name].name, stage.name))
+            if any(name in other.inputs for other in self.stages):
+                raise Exception("Value %s of stage %s is read by a preceding stage" % (name, stage.name))
+            self.producers[name] = stage
+        self.stages.append(stage)
+
+    @property
+    def inputs(self):
+        """Names of values that have to be set with set_input"""
+        names = []
+        for stage in self.stages:
+            names += [name for name in stage.inputs if name not in self.producers and name not in names]
+        return names
+
+    def stage(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        raise Exception("Unknown stage: %s" % name)
+
+    def _set_value(self, name, value):
+        self._version += 1
+        self.values[name] = value
+        self.versions[name] = self._version
+
+    def set_input(self, name, value):
+        """Sets input of the graph, stages reading it are computed again on next run
+        :param name:
+        :param value:
+        """
+        if name in self.producers:
+            raise Exception("Value %s is produced by stage %s" % (name, self.producers[name].name))
+        self._set_value(name, value)
+
+    def set_inputs(self, **values):
+        for name, value in values.items():
+            self.set_input(name, value)
+
+    def set_params(self, stage_name, **params):
+        """Changes parameters of a stage, the stage and stages depending on
+        it are computed again on next run
+        :param stage_name:
+        :param params: keyword parameters of stage function
+        """
+        self.stage(stage_name).params.update(params)
+
+    def invalidate(self, stage_name=None):
+        """Forgets that a stage was computed, all stages when stage name is None
+        :param stage_name:
+        """
+        if stage_name is None:
+            self._signatures.clear()
+        else:
+            self._signatures.pop(self.stage(stage_name).name, None)
+
+    def _signature(self, stage):
+        return tuple(self.versions[name] for name in stage.inputs), sorted(stage.params.items())
+
+    def is_stale(self, stage):
+        """Whether stage has to be computed, assuming its inputs are up to date"""
+        if any(name not in self.values for name in stage.outputs):
+            return True
+        return self._signatures.get(stage.name) != self._signature(stage)
+
+    def _required(self, targets):
+        required = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            stage = self.producers.get(name)
+            if stage is None or stage.name in required:
+                continue
+            required.add(stage.name)
+            pending += stage.inputs
+        return required
+
+    def run(self, targets=None):
+        """Computes stale stages in order
+        :param targets: names of values that are needed, defaults to all outputs
+        :return: dict of target values
+        """
+        if targets is None:
+            targets = list(self.producers)
+        required = self._required(targets)
+        self.recomputed = []
+        for stage in self.stages:
+            if stage.name not in required:
+                continue
+            missing = [name for name in stage.inputs if name not in self.values]
+            if missing:
+                raise Exception("Stage %s is missing inputs: %s" % (stage.name, ", ".join(missing)))
+            if not self.is_stale(stage):
+                continue
+            signature = self._signature(stage)
+            with ins.span('stage:' + stage.name):
+                result = stage.function(*[self.values[name] for name in stage.inputs], **stage.params)
+            if len(stage.outputs) == 1:
+                result = (result,)
+            for name, value in zip(stage.outputs, result):
+                self._set_value(name, value)
+            self._signatures[stage.name] = signature
+            self.recomputed += [stage.name]
+        return dict((name, self.values[name]) for name in targets)
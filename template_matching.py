@@ -1,13 +1,206 @@
 import os
+from collections import OrderedDict
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import image_processing as imp
+import instrumentation as ins
+import packed_image as pim
 
+REFERENCE_MATCHING = 0
+VECTORIZED_MATCHING = 1
+BOUNDED_MATCHING = 2
+PACKED_MATCHING = 3
 
-def search_for_templates(template_filepaths):
+TEMPLATES_ROOT = "%s/templates" % os.path.dirname(os.path.abspath(__file__))
+
+
+class TemplateLibrary(object):
+    """Template images shared by all classifiers. Every template
+    file is decoded only once, and binarized templates are kept
+    in a LRU cache by filepath and size, together with their
+    packed copies once those are needed.
+    """
+
+    def __init__(self, max_size=1024):
+        """
+        :param max_size: maximum number of cached binarized templates
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._decoded = {}
+        self._binarized = OrderedDict()
+        self._packed = {}
+
+    def get(self, filepath, size=None):
+        """Return binarized and inverted template image,
+        optionally resized to size
+        :param filepath:
+        :param size:
+        """
+        key = (filepath, size)
+        template = self._binarized.get(key)
+        if template is not None:
+            self._binarized.move_to_end(key)
+            self.hits += 1
+            ins.count(ins.CACHE_HITS)
+            return template
+
+        self.misses += 1
+        ins.count(ins.CACHE_MISSES)
+        if filepath not in self._decoded:
+            self._decoded[filepath] = imp.load_image(filepath)
+        template = binarize_template(self._decoded[filepath], size)
+        template.flags.writeable = False
+        self._binarized[key] = template
+        if len(self._binarized) > self.max_size:
+            evicted_key = self._binarized.popitem(last=False)[0]
+            self._packed.pop(evicted_key, None)
+            self.evictions += 1
+        return template
+
+    def get_packed(self, filepath, size=None):
+        """Return template of get packed to bits
+        :param filepath:
+        :param size:
+        """
+        template = self.get(filepath, size)
+        key = (filepath, size)
+        packed = self._packed.get(key)
+        if packed is None:
+            packed = pim.PackedImage.from_image(template)
+            self._packed[key] = packed
+        return packed
+
+    def get_templates(self, template_filepaths, size=None, packed=False):
+        """Make dictionary of images from template_filepaths.
+        :param template_filepaths:
+        :param size:
+        :param packed: make PackedImage templates
+        """
+        get = self.get_packed if packed else self.get
+        templates = {}
+        for filepath in template_filepaths:
+            templates[filepath] = get(filepath, size)
+        return templates
+
+    def clear(self):
+        """Remove all decoded and binarized templates and reset counters"""
+        self._decoded.clear()
+        self._binarized.clear()
+        self._packed.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+TEMPLATE_LIBRARY = TemplateLibrary()
+
+
+class TemplateCatalogue(object):
+    """Index of template files in the templates folder.
+    The folder is scanned once, and template filepaths
+    are served from a trie over "folder/filename" keys.
+    """
+
+    def __init__(self, root=TEMPLATES_ROOT):
+        """
+        :param root: folder containing template folders
+        """
+        self.root = root
+        self._trie = {}
+        self._folder_mtimes = {}
+        self._scanned = False
+        self._count = 0
+
+    def set_root(self, root):
+        """Use another templates folder, it will be scanned on next search
+        :param root:
+        """
+        self.root = root
+        self._trie = {}
+        self._folder_mtimes = {}
+        self._scanned = False
+        self._count = 0
+
+    def search(self, template_filepath):
+        """Return filepaths of templates in the folder and optionally
+        starting with the prefix, given as "folder/prefix".
+        Filepaths are in the order they were listed from the folder.
+        :param template_filepath:
+        """
+        if not self._scanned:
+            self.refresh()
+        split = template_filepath.split('/')
+        node = self._find_node(split[0] + '/' + (split[1] if len(split) > 1 else ''))
+        templates = []
+        if node is not None:
+            self._collect(node, templates)
+        return [filepath for index, filepath in sorted(templates)]
+
+    def refresh(self):
+        """Scan the templates folder and rescan only the template
+        folders that were added, removed or modified since the last scan.
+        """
+        folders = set()
+        for folder in os.listdir(self.root):
+            folder_path = "%s/%s" % (self.root, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            folders.add(folder)
+            mtime = os.stat(folder_path).st_mtime
+            if self._folder_mtimes.get(folder) != mtime:
+                self._folder_mtimes[folder] = mtime
+                self._index_folder(folder)
+        for folder in list(self._folder_mtimes):
+            if folder not in folders:
+                del self._folder_mtimes[folder]
+                self._remove_folder(folder)
+        self._scanned = True
+
+    def _index_folder(self, folder):
+        self._remove_folder(folder)
+        for filename in os.listdir("%s/%s" % (self.root, folder)):
+            node = self._trie
+            for char in folder + '/' + filename:
+                node = node.setdefault(char, {})
+            node[''] = (self._count, "%s/%s/%s" % (self.root, folder, filename))
+            self._count += 1
+
+    def _remove_folder(self, folder):
+        node = self._find_node(folder)
+        if node is not None:
+            node.pop('/', None)
+
+    def _find_node(self, key):
+        node = self._trie
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _collect(self, node, templates):
+        for key in node:
+            if key == '':
+                templates.append(node[key])
+            else:
+                self._collect(node[key], templates)
+
+
+TEMPLATE_CATALOGUE = TemplateCatalogue()
+
+
+def search_for_templates(template_filepaths, template_catalogue=None):
     """Search for template images in templates folder
     that are in specified folders and optionally
     start with specified prefix
     :param template_filepaths:
+    :param template_catalogue: defaults to TEMPLATE_CATALOGUE
     """
+    if template_catalogue is None:
+        template_catalogue = TEMPLATE_CATALOGUE
 
     templates = []
     if type(template_filepaths) == str:
@@ -16,20 +209,18 @@ def search_for_templates(template_filepaths):
         filenames = template_filepaths
 
     for filename in filenames:
-        split = filename.split('/')
-        for listedFile in os.listdir("templates"):
-            if listedFile == split[0]:
-                for innerFile in os.listdir("templates/%s" % listedFile):
-                    if len(split) == 1 or innerFile.startswith(split[1]):
-                        templates += ["templates/%s/%s" % (listedFile, innerFile)]
-        return templates
+        templates += template_catalogue.search(filename)
+    return templates
 
 
 def template_match(obj,
                    template_filepaths=None,
                    template_images=None,
                    resize=False,
-                   print_results=True):
+                   print_results=True,
+                   matching=BOUNDED_MATCHING,
+                   template_library=None,
+                   min_match=0):
     """Return best match from templates for image
     containing the object (region).
     :param obj:
@@ -37,10 +228,25 @@ def template_match(obj,
     :param template_images:
     :param resize:
     :param print_results:
+    :param matching: BOUNDED_MATCHING, PACKED_MATCHING, VECTORIZED_MATCHING or
+    REFERENCE_MATCHING. PACKED_MATCHING and BOUNDED_MATCHING skip templates that can
+    not beat the best match so far or reach min_match at any position.
+    BOUNDED_MATCHING also stops scoring positions that can no longer do so,
+    PACKED_MATCHING scores every position of the other templates, comparing
+    images packed to bits. VECTORIZED_MATCHING is used instead of PACKED_MATCHING
+    when obj is not binary.
+    :param template_library: defaults to TEMPLATE_LIBRARY
+    :param min_match: best match below it is not a match, (None, 0) is returned instead
     """
     obj_height, obj_width = obj.shape[:2]
     best_match = (None, 0)
     templates = {}
+    packed_obj = None
+    if matching == PACKED_MATCHING:
+        if pim.is_binary(obj):
+            packed_obj = pim.PackedImage.from_image(obj)
+        else:
+            matching = VECTORIZED_MATCHING
     if template_filepaths is None and template_images is None:
         raise Exception("Missing template filepaths or template images")
     elif template_filepaths is not None and template_images is not None:
@@ -50,27 +256,29 @@ def template_match(obj,
         templates = make_template_images(template_filepaths,
                                          size=None if not resize
                                          else (int(round(obj_width)),
-                                               int(round(obj_height))))
+                                               int(round(obj_height))),
+                                         template_library=template_library,
+                                         packed=packed_obj is not None)
     elif template_images is not None:
         if type(template_images) != dict:
             raise Exception("Template images must be a dictionary, with"
                             "filepaths for keys and images for values!")
         templates = template_images
 
+    ins.count(ins.TEMPLATE_COMPARISONS, len(templates))
+    ins.count(ins.PIXELS_SCANNED, obj.size * len(templates))
+    white = integral_white(obj) if matching in (BOUNDED_MATCHING, PACKED_MATCHING) else None
     for templateName, template in templates.items():
-        template_height, template_width = template.shape[:2]
-        for row in range(obj_height - template_height + 1):
-            for col in range(obj_width - template_width + 1):
-                match = 0
-                for r in range(template_height):
-                    for c in range(template_width):
-                        match += 1\
-                            if obj[row + r][col + c] == template[r][c]\
-                            else 0
-                match *= 1. / (template_height * template_width)
-
-                if match > best_match[1]:
-                    best_match = (templateName, match)
+        if matching == BOUNDED_MATCHING:
+            match = bounded_template_match(obj, template, best_match[1], min_match, white)
+        elif packed_obj is not None:
+            match = packed_template_match(packed_obj, template, best_match[1], min_match, white)
+        else:
+            match = best_template_match(obj, template, matching)
+        if match > best_match[1]:
+            best_match = (templateName, match)
+    if best_match[1] < min_match:
+        best_match = (None, 0)
 
     if print_results:
         if best_match[0] is None:
@@ -81,18 +289,209 @@ def template_match(obj,
     return best_match
 
 
-def make_template_images(template_filepaths, size=None):
+def best_template_match(obj, template, matching=VECTORIZED_MATCHING):
+    """Return the best fraction of equal pixels over all positions
+    of the template inside obj, or 0 if the template doesn't fit.
+    :param obj:
+    :param template:
+    :param matching:
+    """
+    if matching == REFERENCE_MATCHING:
+        return best_template_match_reference(obj, template)
+    elif matching == VECTORIZED_MATCHING:
+        scores = match_score_map(obj, template)
+        if scores.size == 0:
+            return 0
+        return float(scores.max())
+    raise Exception("Unknown template matching method: %s" % matching)
+
+
+def match_score_map(obj, template):
+    """Return a map with the fraction of equal pixels for every
+    position of the template inside obj. The map is computed one
+    template row at a time over all positions at once.
+    :param obj:
+    :param template:
+    """
+    obj_height, obj_width = obj.shape[:2]
+    template_height, template_width = template.shape[:2]
+    map_height = max(obj_height - template_height + 1, 0)
+    map_width = max(obj_width - template_width + 1, 0)
+    counts = np.zeros((map_height, map_width), dtype=np.int64)
+    if map_height > 0 and map_width > 0:
+        for r in range(template_height):
+            windows = sliding_window_view(obj[r:r + map_height], template_width, axis=1)
+            counts += (windows == template[r]).sum(axis=2)
+    return counts * (1. / (template_height * template_width))
+
+
+def bounded_template_match(obj, template, best=0, min_match=0, white=None):
+    """Return best_template_match if it is above best and not below
+    min_match, otherwise 0. Positions are scored one template row at
+    a time, and a position is dropped as soon as its equal pixels so far
+    and all the pixels left can not beat best, reach min_match or reach
+    equal pixels of another position. Before scoring, equal pixels of
+    every position are bounded by the difference of white pixel counts
+    of the template and the window, taken from an integral image, so
+    templates that can not reach the threshold anywhere are skipped.
+    :param obj:
+    :param template:
+    :param best: best match so far
+    :param min_match:
+    :param white: integral_white of obj, computed when not given
+    """
+    obj_height, obj_width = obj.shape[:2]
+    template_height, template_width = template.shape[:2]
+    map_height = obj_height - template_height + 1
+    map_width = obj_width - template_width + 1
+    if map_height <= 0 or map_width <= 0:
+        return 0
+    size = template_height * template_width
+    scale = 1. / size
+    needed = needed_equal_pixels(size, best, min_match)
+    if needed > size:
+        return 0
+
+    if white is None:
+        white = integral_white(obj)
+    bound = white_count_bound(white, template_height, template_width, np.count_nonzero(template == 255))
+    rows, cols = np.nonzero(bound >= needed)
+    if len(rows) == 0:
+        return 0
+
+    counts = np.zeros(len(rows), dtype=np.int64)
+    window_cols = cols[:, np.newaxis] + np.arange(template_width)
+    for r in range(template_height):
+        counts += (obj[rows[:, np.newaxis] + r, window_cols] == template[r]).sum(axis=1)
+        left = (template_height - r - 1) * template_width
+        keep = counts + left >= max(needed, counts.max())
+        if not keep.all():
+            rows, window_cols, counts = rows[keep], window_cols[keep], counts[keep]
+            if len(counts) == 0:
+                return 0
+    if counts.max() < needed:
+        return 0
+    return float(counts.max() * scale)
+
+
+def packed_template_match(obj, template, best=0, min_match=0, white=None):
+    """Return best_template_match of binary images if it is above best
+    and not below min_match, otherwise 0. Images are compared packed to
+    bits. A template that can not reach the threshold at any position by
+    white_count_bound is skipped, one that is not binary is compared
+    byte by byte.
+    :param obj: PackedImage
+    :param template: PackedImage or binary image
+    :param best: best match so far
+    :param min_match:
+    :param white: integral_white of obj, computed when not given
+    """
+    if not isinstance(template, pim.PackedImage):
+        if not pim.is_binary(template):
+            return bounded_template_match(obj.unpack(), template, best, min_match, white)
+        template = pim.PackedImage.from_image(template)
+    if obj.height < template.height or obj.width < template.width:
+        return 0
+    size = template.size
+    needed = needed_equal_pixels(size, best, min_match)
+    if needed > size:
+        return 0
+    if white is None:
+        white = integral_white(obj.unpack())
+    if not (white_count_bound(white, template.height, template.width, template.count_white()) >= needed).any():
+        return 0
+
+    equal = size - pim.mismatch_map(obj, template).min()
+    if equal < needed:
+        return 0
+    return float(equal * (1. / size))
+
+
+def integral_white(obj):
+    """Return integral image of white pixels of obj, with a row
+    and a column of zeros before the first ones
+    :param obj:
+    """
+    white = np.zeros((obj.shape[0] + 1, obj.shape[1] + 1), dtype=np.int64)
+    white[1:, 1:] = np.cumsum(np.cumsum(obj == 255, axis=0), axis=1)
+    return white
+
+
+def white_count_bound(white, template_height, template_width, template_white):
+    """Return a map with an upper bound of equal pixels for every
+    position of a template inside obj, size of the template less the
+    difference of white pixels of the template and of the window.
+    :param white: integral_white of obj
+    :param template_height:
+    :param template_width:
+    :param template_white: number of white pixels of the template
+    """
+    map_height = white.shape[0] - template_height
+    map_width = white.shape[1] - template_width
+    window_white = white[template_height:, template_width:] - white[:map_height, template_width:] \
+        - white[template_height:, :map_width] + white[:map_height, :map_width]
+    return template_height * template_width - np.abs(window_white - template_white)
+
+
+def needed_equal_pixels(size, best=0, min_match=0):
+    """Return smallest number of equal pixels of a template of size
+    pixels whose match is above best and not below min_match,
+    size + 1 if there is none.
+    :param size:
+    :param best:
+    :param min_match:
+    """
+    scale = 1. / size
+    needed = max(int(best * size), int(min_match * size) - 1, 0)
+    while needed <= size and not (needed * scale > best and needed * scale >= min_match):
+        needed += 1
+    return needed
+
+
+def best_template_match_reference(obj, template):
+    """Pixel by pixel implementation of best_template_match,
+    kept for parity checks.
+    :param obj:
+    :param template:
+    """
+    obj_height, obj_width = obj.shape[:2]
+    template_height, template_width = template.shape[:2]
+    best_match = 0
+    for row in range(obj_height - template_height + 1):
+        for col in range(obj_width - template_width + 1):
+            match = 0
+            for r in range(template_height):
+                for c in range(template_width):
+                    match += 1\
+                        if obj[row + r][col + c] == template[r][c]\
+                        else 0
+            match *= 1. / (template_height * template_width)
+
+            if match > best_match:
+                best_match = match
+    return best_match
+
+
+def make_template_images(template_filepaths, size=None, template_library=None, packed=False):
     """Make dictionary of images from template_filepaths.
     :param template_filepaths:
     :param size:
+    :param template_library: defaults to TEMPLATE_LIBRARY
+    :param packed: make PackedImage templates
     """
-    templates = {}
-    for filepath in template_filepaths:
-        template = imp.load_image(filepath)
-        if size is not None:
-            template = imp.resize_image(template, size)
-        template = imp.image_gray(template)
-        template = imp.image_bin_otsu(template)
-        template = imp.invert(template)
-        templates[filepath] = template
-    return templates
+    if template_library is None:
+        template_library = TEMPLATE_LIBRARY
+    return template_library.get_templates(template_filepaths, size, packed)
+
+
+def binarize_template(template, size=None):
+    """Resize, binarize and invert loaded template image.
+    :param template:
+    :param size:
+    """
+    if size is not None:
+        template = imp.resize_image(template, size)
+    template = imp.image_gray(template)
+    template = imp.image_bin_otsu(template)
+    template = imp.invert(template)
+    return template